@@ -1,17 +1,24 @@
 """Telegram bot for ARGSMS - SMS range management system."""
 
 import os
+import asyncio
+import io
 import json
 import logging
 import random
 import re
+import tempfile
 import traceback
 from datetime import datetime, timedelta
-from io import BytesIO
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache, partial
+from itertools import islice
+from time import monotonic
 from dotenv import load_dotenv
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     CallbackQueryHandler,
@@ -21,36 +28,45 @@ from telegram.ext import (
     ConversationHandler
 )
 
-import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment
+import xlsxwriter
 
 from database import (
     init_db,
     get_or_create_user,
+    get_user_by_id,
+    get_user_by_telegram_id,
+    get_users_page,
     log_access,
+    flush_access_logs,
     is_user_admin,
+    cache_admin_flag,
     is_user_banned,
     get_user_balance,
     add_user_balance,
     deduct_user_balance,
     get_price_for_range,
+    get_set_price,
+    get_latest_price_ranges,
     create_number_holds,
-    mark_number_permanent,
+    charge_for_sms,
+    SMS_ALREADY_CHARGED,
     get_held_numbers,
     is_number_held,
     cleanup_expired_holds,
     update_first_retry_time,
     get_all_active_holds,
+    get_hold_summary,
+    get_bot_stats,
+    get_hold_breakdown,
     User,
     NumberHold,
-    PriceRange,
     Transaction,
     RechargeRequest,
-    AccessLog,
     Range,
     PhoneNumber,
     import_csv_data,
     get_all_ranges,
+    get_all_ranges_with_prices,
     get_range_by_unique_id,
     get_available_numbers_for_range,
     delete_range_and_numbers,
@@ -95,6 +111,47 @@ SMS_DISPLAY_COUNT = 20  # How many random numbers to display
 # Constants for SMS message display
 MAX_TELEGRAM_MESSAGE_LENGTH = 3500  # Leave room for additional text
 
+# Smallest money unit accepted from admin input
+CENT = Decimal('0.01')
+
+# Characters that must be escaped in Telegram HTML messages
+HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Admin balance replies, shared by the by-ID and user-list flows
+BALANCE_ADDED_TEMPLATE = "✅ Successfully added ${:.2f} to {}\nNew balance: ${:.2f}".format
+BALANCE_DEDUCTED_TEMPLATE = "✅ Successfully deducted ${:.2f} from {}\nNew balance: ${:.2f}".format
+
+# Strips everything but digits and + from phone number input
+PHONE_CLEAN_RE = re.compile(r'[^\d+]')
+
+# Excel exports larger than this are spooled to disk instead of memory
+EXPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+EXPORT_UPLOAD_TIMEOUT = 120  # seconds
+
+# Cell formats shared by Excel exports
+EXCEL_HEADER_FORMAT = {
+    'bold': True,
+    'font_color': '#FFFFFF',
+    'bg_color': '#366092',
+    'align': 'center',
+    'valign': 'vcenter'
+}
+EXCEL_TITLE_FORMAT = {'bold': True, 'font_size': 14}
+EXCEL_LABEL_FORMAT = {'bold': True}
+
+# Admin user list pagination
+USERS_PAGE_SIZE = 20
+USER_CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'  # Compact enough for callback_data
+
+# How long admin dashboard figures are reused before being recomputed
+ADMIN_STATS_CACHE_TTL = 30  # seconds
+
+# How long a user's held numbers are reused for SMS checks
+HOLDS_CACHE_TTL = 60  # seconds
+
+# How often queued access logs are written to the database
+ACCESS_LOG_FLUSH_INTERVAL = 0.5  # seconds
+
 # Conversation states for admin operations
 WAITING_FOR_ADD_BALANCE_AMOUNT = 1
 WAITING_FOR_DEDUCT_BALANCE_AMOUNT = 2
@@ -111,11 +168,82 @@ def get_db_session():
     return SessionFactory()
 
 
+# Cached admin dashboard figures: key -> (stored_at, value)
+_admin_stats_cache = {}
+
+
+def get_cached_admin_stats(key):
+    """Return cached admin dashboard data, or None if missing or stale."""
+    entry = _admin_stats_cache.get(key)
+    if entry and monotonic() - entry[0] < ADMIN_STATS_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def set_cached_admin_stats(key, value):
+    """Store admin dashboard data in the cache."""
+    _admin_stats_cache[key] = (monotonic(), value)
+
+
+def invalidate_admin_stats():
+    """Drop cached admin dashboard data after holds change."""
+    _admin_stats_cache.clear()
+
+
+class AdminSession:
+    """Pending multi-step admin action and the values collected for it."""
+    __slots__ = (
+        'action', 'target_user_id', 'target_telegram_id',
+        'selected_range_id', 'selected_range_name',
+        'range_unique_id', 'range_name',
+    )
+    
+    def __init__(self, action=None, **fields):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.action = action
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+
+def start_admin_session(context, action, **fields):
+    """Start (or replace) the pending admin action of the current user."""
+    context.user_data['admin_session'] = AdminSession(action, **fields)
+
+
+def get_admin_session(context):
+    """Return the pending admin action, or an empty one if there is none."""
+    return context.user_data.get('admin_session') or AdminSession()
+
+
+def end_admin_session(context):
+    """Forget the pending admin action without touching other user data."""
+    context.user_data.pop('admin_session', None)
+
+
+def parse_positive_amount(text):
+    """Parse a money amount typed by an admin, rounded to cents.
+    
+    Returns a float for the balance/price columns, or None unless the text is
+    a finite number that is still positive after rounding.
+    """
+    try:
+        amount = Decimal(text).quantize(CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+    if not amount.is_finite() or amount <= 0:
+        return None
+    return float(amount)
+
+
 def escape_html(text):
     """Escape HTML special characters for safe display in Telegram messages."""
     if text is None:
         return ""
-    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if not isinstance(text, str):
+        text = str(text)
+    # One C-level pass instead of three chained replace() calls
+    return text.translate(HTML_ESCAPE_TABLE)
 
 
 def strip_html_tags(html_str):
@@ -326,6 +454,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Admin panel callbacks
         elif callback_data == "admin_list_users":
             await admin_list_users_callback(query, context, db, db_user)
+        elif callback_data.startswith("admin_list_users_next_"):
+            # Keyset cursor of the last user shown: <created_at>_<id>
+            created_str, user_id = callback_data[len("admin_list_users_next_"):].split("_")
+            cursor = (datetime.strptime(created_str, USER_CURSOR_TIME_FORMAT), int(user_id))
+            await admin_list_users_callback(query, context, db, db_user, cursor)
         elif callback_data == "admin_manage_admins":
             await admin_manage_admins_callback(query, context, db, db_user)
         elif callback_data == "admin_manage_bans":
@@ -356,6 +489,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             range_unique_id = callback_data.replace("range_", "")
             await view_sms_range_detail_callback(query, context, db, db_user, range_unique_id)
         
+        # Set price for specific range callback (checked before the
+        # shorter set_price_ prefix, which would otherwise match it)
+        elif callback_data.startswith("set_price_for_range_"):
+            range_index = int(callback_data[len("set_price_for_range_"):])
+            await set_price_for_range_callback(query, context, db, db_user, range_index)
+        
         # Set price for a range
         elif callback_data.startswith("set_price_"):
             range_unique_id = callback_data.replace("set_price_", "")
@@ -406,11 +545,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = int(callback_data.split("_")[3])
             await deduct_balance_prompt_callback(query, context, db, db_user, user_id)
         
-        # Set price for specific range callback
-        elif callback_data.startswith("set_price_for_range_"):
-            range_id = callback_data[len("set_price_for_range_"):]
-            await set_price_for_range_callback(query, context, db, db_user, range_id)
-        
         # Select range for price setting
         elif callback_data == "select_range_for_price":
             await select_range_for_price_callback(query, context, db, db_user)
@@ -562,7 +696,8 @@ async def view_sms_numbers_callback(query, context, db, db_user, range_unique_id
     log_access(db, db_user, f"view_sms_numbers_{range_unique_id}")
     
     # Clean up expired holds
-    cleanup_expired_holds(db)
+    if cleanup_expired_holds(db):
+        clear_holds_caches(context.application)
     
     # Get range from database
     range_obj = get_range_by_unique_id(db, range_unique_id)
@@ -621,6 +756,9 @@ async def view_sms_numbers_callback(query, context, db, db_user, range_unique_id
     phone_number_ids = [num.id for num in selected_numbers]
     create_number_holds(db, db_user, phone_number_ids, range_unique_id)
     
+    # Previous temporary holds were released, so cached holds are outdated
+    context.user_data.pop('holds_cache', None)
+    
     # Store selected numbers in context for SMS checking
     if 'selected_numbers' not in context.user_data:
         context.user_data['selected_numbers'] = {}
@@ -692,29 +830,36 @@ async def back_to_main_callback(query, context, db, db_user):
     await query.edit_message_text(welcome_message, reply_markup=reply_markup)
 
 
-async def admin_list_users_callback(query, context, db, db_user):
-    """List all users (admin only)."""
+async def admin_list_users_callback(query, context, db, db_user, cursor=None):
+    """List users newest first, one page at a time (admin only)."""
     if not is_user_admin(db, db_user.telegram_id):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
     log_access(db, db_user, "admin_list_users")
     
-    # Get all users
-    users = db.query(User).order_by(User.created_at.desc()).limit(20).all()
+    # Fetch one extra row to know whether there is a next page
+    users = get_users_page(db, cursor, USERS_PAGE_SIZE + 1)
+    has_more = len(users) > USERS_PAGE_SIZE
+    users = users[:USERS_PAGE_SIZE]
     
-    message = "👥 User List (Last 20)\n\n"
+    title = "👥 User List (continued)" if cursor else f"👥 User List (Last {USERS_PAGE_SIZE})"
+    parts = [f"{title}\n\n"]
     for user in users:
         admin_badge = "🔑" if user.is_admin else "👤"
         ban_badge = "🚫" if user.is_banned else ""
         username_str = f"@{user.username}" if user.username else "N/A"
-        message += f"{admin_badge}{ban_badge} ID: {user.telegram_id} | {username_str}\n"
-        message += f"   Balance: ${user.balance:.2f} | Joined: {user.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+        parts.append(f"{admin_badge}{ban_badge} ID: {user.telegram_id} | {username_str}\n")
+        parts.append(f"   Balance: ${user.balance:.2f} | Joined: {user.created_at.strftime('%Y-%m-%d %H:%M')}\n\n")
+    message = "".join(parts)
     
-    keyboard = [
-        [InlineKeyboardButton("🔑 Manage Admins", callback_data="admin_manage_admins")],
-        [InlineKeyboardButton("⬅️ Back to Admin Panel", callback_data="admin_back")]
-    ]
+    keyboard = []
+    if has_more:
+        last_user = users[-1]
+        next_cursor = f"{last_user.created_at.strftime(USER_CURSOR_TIME_FORMAT)}_{last_user.id}"
+        keyboard.append([InlineKeyboardButton("➡️ Next Page", callback_data=f"admin_list_users_next_{next_cursor}")])
+    keyboard.append([InlineKeyboardButton("🔑 Manage Admins", callback_data="admin_manage_admins")])
+    keyboard.append([InlineKeyboardButton("⬅️ Back to Admin Panel", callback_data="admin_back")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(message, reply_markup=reply_markup)
@@ -737,7 +882,7 @@ async def admin_manage_admins_callback(query, context, db, db_user):
     keyboard = []
     for user in users:
         admin_badge = "🔑" if user.is_admin else "👤"
-        username_str = f"@{user.username}" if user.username else f"ID:{user.telegram_id}"
+        username_str = user.display_handle
         button_text = f"{admin_badge} {username_str}"
         
         if user.is_admin:
@@ -761,39 +906,28 @@ async def admin_view_stats_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_view_stats")
     
-    # Get statistics
-    from sqlalchemy import func
-    
-    total_users = db.query(User).count()
-    admin_users = db.query(User).filter_by(is_admin=True).count()
-    banned_users = db.query(User).filter_by(is_banned=True).count()
-    
-    # Calculate total balance in system
-    total_balance = db.query(func.sum(User.balance)).scalar() or 0.0
-    total_spent = db.query(func.sum(User.total_spent)).scalar() or 0.0
-    total_sms = db.query(func.sum(User.total_sms_received)).scalar() or 0
-    
-    # Number holds stats
-    total_holds = db.query(NumberHold).count()
-    permanent_holds = db.query(NumberHold).filter_by(is_permanent=True).count()
-    
-    today = datetime.utcnow().date()
-    today_logs = db.query(AccessLog).filter(
-        func.date(AccessLog.timestamp) == today
-    ).count()
-    
-    message = (
-        "📊 Bot Statistics\n\n"
-        f"👥 Total Users: {total_users}\n"
-        f"🔑 Admin Users: {admin_users}\n"
-        f"🚫 Banned Users: {banned_users}\n\n"
-        f"💰 Total Balance in System: ${total_balance:.2f}\n"
-        f"💸 Total Spent: ${total_spent:.2f}\n"
-        f"📨 Total SMS Received: {total_sms}\n\n"
-        f"🔒 Number Holds: {total_holds}\n"
-        f"🔐 Permanent Holds: {permanent_holds}\n\n"
-        f"📈 Today's Actions: {today_logs}\n"
-    )
+    # Reuse recently computed figures so rapid refreshes don't re-aggregate
+    # the whole database
+    message = get_cached_admin_stats('admin_stats')
+    if message is None:
+        # Run the aggregate queries in a worker thread so they don't block
+        # other updates while the database is busy
+        stats = await asyncio.to_thread(get_bot_stats, db)
+        
+        message = (
+            "📊 Bot Statistics\n\n"
+            f"👥 Total Users: {stats['total_users']}\n"
+            f"🔑 Admin Users: {stats['admin_users']}\n"
+            f"🚫 Banned Users: {stats['banned_users']}\n\n"
+            f"💰 Total Balance in System: ${stats['total_balance']:.2f}\n"
+            f"💸 Total Spent: ${stats['total_spent']:.2f}\n"
+            f"📨 Total SMS Received: {stats['total_sms']}\n\n"
+            f"🔒 Number Holds: {stats['total_holds']}\n"
+            f"🔐 Permanent Holds: {stats['permanent_holds']}\n\n"
+            f"📈 Today's Actions: {stats['today_logs']}\n"
+        )
+        
+        set_cached_admin_stats('admin_stats', message)
     
     keyboard = [[InlineKeyboardButton("⬅️ Back to Admin Panel", callback_data="admin_back")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -809,59 +943,42 @@ async def admin_number_holds_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_number_holds")
     
-    # Get statistics
-    from sqlalchemy import func, Integer
+    overview = get_cached_admin_stats('number_holds')
+    if overview is None:
+        # Aggregates run in a worker thread to keep the event loop responsive
+        total_holds, permanent_holds, _, expired_holds = await asyncio.to_thread(get_hold_summary, db)
+        holds_by_user, holds_by_range = await asyncio.to_thread(get_hold_breakdown, db)
+        overview = (total_holds, permanent_holds, expired_holds, holds_by_user, holds_by_range)
+        set_cached_admin_stats('number_holds', overview)
     
-    # Total holds
-    total_holds = db.query(NumberHold).count()
-    permanent_holds = db.query(NumberHold).filter_by(is_permanent=True).count()
+    total_holds, permanent_holds, expired_holds, holds_by_user, holds_by_range = overview
     temporary_holds = total_holds - permanent_holds
     
-    # Get holds by user
-    holds_by_user = db.query(
-        User.telegram_id,
-        User.username,
-        func.count(NumberHold.id).label('hold_count'),
-        func.sum(func.cast(NumberHold.is_permanent, Integer)).label('permanent_count')
-    ).join(NumberHold).group_by(User.id).order_by(func.count(NumberHold.id).desc()).limit(10).all()
-    
-    # Get holds by range
-    holds_by_range = db.query(
-        NumberHold.range_id,
-        func.count(NumberHold.id).label('hold_count')
-    ).group_by(NumberHold.range_id).order_by(func.count(NumberHold.id).desc()).limit(10).all()
-    
-    # Check for expired temporary holds
-    now = datetime.utcnow()
-    expired_holds = db.query(NumberHold).filter(
-        NumberHold.is_permanent == False,
-        NumberHold.first_retry_time.isnot(None),
-        NumberHold.first_retry_time < now - timedelta(minutes=5)
-    ).count()
-    
-    message = (
+    # Collect message pieces in a list and join once at the end
+    parts = [
         "🔒 <b>Number Holds Analysis</b>\n\n"
         f"📊 <b>Overview:</b>\n"
         f"Total Holds: {total_holds}\n"
         f"├─ Permanent: {permanent_holds}\n"
         f"├─ Temporary: {temporary_holds}\n"
         f"└─ Expired (ready to release): {expired_holds}\n\n"
-    )
+    ]
     
     if holds_by_user:
-        message += "👥 <b>Top Users by Holds:</b>\n"
+        parts.append("👥 <b>Top Users by Holds:</b>\n")
         for telegram_id, username, count, perm_count in holds_by_user:
             username_str = f"@{username}" if username else f"ID:{telegram_id}"
-            message += f"• {username_str}: {count} holds ({perm_count or 0} permanent)\n"
-        message += "\n"
+            parts.append(f"• {username_str}: {count} holds ({perm_count or 0} permanent)\n")
+        parts.append("\n")
     
     if holds_by_range:
-        message += "📱 <b>Top Ranges by Holds:</b>\n"
+        parts.append("📱 <b>Top Ranges by Holds:</b>\n")
         for range_id, count in holds_by_range[:5]:
-            message += f"• {range_id}: {count} numbers\n"
-        message += "\n"
+            parts.append(f"• {range_id}: {count} numbers\n")
+        parts.append("\n")
     
-    message += "💡 Click 'Export Report' to download detailed Excel report"
+    parts.append("💡 Click 'Export Report' to download detailed Excel report")
+    message = "".join(parts)
     
     keyboard = [
         [InlineKeyboardButton("📥 Export Report", callback_data="admin_export_holds")],
@@ -874,22 +991,27 @@ async def admin_number_holds_callback(query, context, db, db_user):
     await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='HTML')
 
 
-async def admin_export_holds_callback(query, context, db, db_user):
-    """Export number holds report as Excel file (admin only)."""
-    if not is_user_admin(db, db_user.telegram_id):
-        await query.answer("❌ Admin access required", show_alert=True)
-        return
+def write_holds_report(db, excel_file, now):
+    """
+    Write the number holds Excel report to a file-like object.
     
-    await query.answer("⏳ Generating report...", show_alert=False)
-    log_access(db, db_user, "admin_export_holds")
+    Args:
+        db: Database session
+        excel_file: Writable, seekable file object to receive the workbook
+        now: Report timestamp used for status calculations
     
-    # Get all holds with user information
-    holds = db.query(NumberHold, User).join(User).order_by(NumberHold.hold_start_time.desc()).all()
+    Returns:
+        Total number of holds in the report
+    """
+    # Stream holds with user information in batches instead of loading them all
+    holds = db.query(NumberHold, User).join(User).order_by(
+        NumberHold.hold_start_time.desc()
+    ).yield_per(500)
     
-    # Create Excel workbook
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Number Holds Report"
+    # Create Excel workbook in constant-memory mode so each row is flushed
+    # to a temporary file as soon as it is written
+    wb = xlsxwriter.Workbook(excel_file, {'constant_memory': True})
+    ws = wb.add_worksheet("Number Holds Report")
     
     # Define headers
     headers = [
@@ -897,20 +1019,21 @@ async def admin_export_holds_callback(query, context, db, db_user):
         "Hold Type", "Hold Start", "First Retry", "Status", "Time Info"
     ]
     
-    # Style for header row
-    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF")
+    # Formats are registered once per workbook and shared by every cell
+    # that uses them
+    header_format = wb.add_format(EXCEL_HEADER_FORMAT)
+    title_format = wb.add_format(EXCEL_TITLE_FORMAT)
+    label_format = wb.add_format(EXCEL_LABEL_FORMAT)
     
     # Write headers
-    for col, header in enumerate(headers, start=1):
-        cell = ws.cell(row=1, column=col, value=header)
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal="center", vertical="center")
+    ws.write_row(0, 0, headers, header_format)
+    
+    # Track the widest value per column while writing, so widths can be
+    # set without a second pass over the data
+    col_widths = [len(header) for header in headers]
     
     # Write data
-    now = datetime.utcnow()
-    for row_idx, (hold, user) in enumerate(holds, start=2):
+    for row_idx, (hold, user) in enumerate(holds, start=1):
         # Calculate status and time info
         if hold.is_permanent:
             status = "Permanent"
@@ -929,49 +1052,34 @@ async def admin_export_holds_callback(query, context, db, db_user):
             time_info = "Not yet retried"
         
         # Write row data
-        ws.cell(row=row_idx, column=1, value=user.telegram_id)
-        ws.cell(row=row_idx, column=2, value=user.username or "N/A")
-        ws.cell(row=row_idx, column=3, value=hold.phone_number)
-        ws.cell(row=row_idx, column=4, value=hold.range_id)
-        ws.cell(row=row_idx, column=5, value="Permanent" if hold.is_permanent else "Temporary")
-        ws.cell(row=row_idx, column=6, value=hold.hold_start_time.strftime('%Y-%m-%d %H:%M:%S'))
-        ws.cell(row=row_idx, column=7, value=hold.first_retry_time.strftime('%Y-%m-%d %H:%M:%S') if hold.first_retry_time else "N/A")
-        ws.cell(row=row_idx, column=8, value=status)
-        ws.cell(row=row_idx, column=9, value=time_info)
-    
-    # Auto-adjust column widths
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[column].width = adjusted_width
+        row = [
+            user.telegram_id,
+            user.username or "N/A",
+            hold.phone_number_str,
+            hold.range_id,
+            "Permanent" if hold.is_permanent else "Temporary",
+            hold.hold_start_time.strftime('%Y-%m-%d %H:%M:%S'),
+            hold.first_retry_time.strftime('%Y-%m-%d %H:%M:%S') if hold.first_retry_time else "N/A",
+            status,
+            time_info
+        ]
+        ws.write_row(row_idx, 0, row)
+        for col_idx, value in enumerate(row):
+            col_widths[col_idx] = max(col_widths[col_idx], len(str(value)))
+    
+    # Column widths can be set after the rows even in constant-memory mode
+    for col_idx, width in enumerate(col_widths):
+        ws.set_column(col_idx, col_idx, min(width + 2, 50))
     
     # Add summary sheet
-    summary_ws = wb.create_sheet("Summary")
-    summary_ws['A1'] = "Number Holds Summary"
-    summary_ws['A1'].font = Font(bold=True, size=14)
+    summary_ws = wb.add_worksheet("Summary")
+    summary_ws.set_column(0, 1, 30)
+    summary_ws.write(0, 0, "Number Holds Summary", title_format)
     
-    total_holds = len(holds)
-    permanent_count = sum(1 for hold, _ in holds if hold.is_permanent)
+    # Summary figures come from a single aggregate query
+    total_holds, permanent_count, active_temp_count, expired_count = get_hold_summary(db, now=now)
     temporary_count = total_holds - permanent_count
     
-    expired_count = 0
-    active_temp_count = 0
-    for hold, _ in holds:
-        if not hold.is_permanent:
-            if hold.first_retry_time:
-                expire_time = hold.first_retry_time + timedelta(minutes=5)
-                if now > expire_time:
-                    expired_count += 1
-                else:
-                    active_temp_count += 1
-    
     summary_data = [
         ("Total Holds", total_holds),
         ("Permanent Holds", permanent_count),
@@ -981,25 +1089,47 @@ async def admin_export_holds_callback(query, context, db, db_user):
         ("Report Generated", now.strftime('%Y-%m-%d %H:%M:%S UTC'))
     ]
     
-    for idx, (label, value) in enumerate(summary_data, start=3):
-        summary_ws.cell(row=idx, column=1, value=label).font = Font(bold=True)
-        summary_ws.cell(row=idx, column=2, value=value)
+    for row_idx, (label, value) in enumerate(summary_data, start=2):
+        summary_ws.write(row_idx, 0, label, label_format)
+        summary_ws.write(row_idx, 1, value)
     
-    summary_ws.column_dimensions['A'].width = 30
-    summary_ws.column_dimensions['B'].width = 30
+    # Write the workbook to the output file
+    wb.close()
+    
+    return total_holds
+
+
+async def admin_export_holds_callback(query, context, db, db_user):
+    """Export number holds report as Excel file (admin only)."""
+    if not is_user_admin(db, db_user.telegram_id):
+        await query.answer("❌ Admin access required", show_alert=True)
+        return
     
-    # Save to BytesIO
-    excel_file = BytesIO()
-    wb.save(excel_file)
-    excel_file.seek(0)
+    await query.answer("⏳ Generating report...", show_alert=False)
+    log_access(db, db_user, "admin_export_holds")
     
-    # Send file to admin
+    now = datetime.utcnow()
     filename = f"number_holds_report_{now.strftime('%Y%m%d_%H%M%S')}.xlsx"
     
+    # Small reports stay in memory, large ones spill over to disk
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE, suffix='.xlsx') as excel_file:
+        # Row writing and zipping the workbook are CPU bound, so build the
+        # report in a worker thread instead of on the event loop
+        total_holds = await asyncio.to_thread(write_holds_report, db, excel_file, now)
+        excel_file.seek(0)
+        
+        # Hand the contents over directly: an in-memory spooled file has no
+        # name, which the telegram file loader would otherwise try to use.
+        # InputFile reads the whole file anyway, so the spooled copy is
+        # closed before the upload starts and only one copy stays alive.
+        report = InputFile(excel_file.read(), filename=filename)
+    
+    # Send file to admin; large reports need longer than the default
+    # write timeout to upload
     await context.bot.send_document(
         chat_id=query.message.chat_id,
-        document=excel_file,
-        filename=filename,
+        document=report,
+        write_timeout=EXPORT_UPLOAD_TIMEOUT,
         caption=f"📊 Number Holds Report\n\nTotal Records: {total_holds}\nGenerated: {now.strftime('%Y-%m-%d %H:%M:%S UTC')}"
     )
     
@@ -1017,6 +1147,8 @@ async def admin_cleanup_holds_callback(query, context, db, db_user):
     
     # Cleanup expired holds
     cleaned = cleanup_expired_holds(db)
+    invalidate_admin_stats()
+    clear_holds_caches(context.application)
     
     await query.answer(f"✅ Cleaned up {cleaned} expired holds", show_alert=True)
     
@@ -1032,16 +1164,14 @@ async def admin_release_all_holds_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_release_all_holds")
     
-    # Count temporary holds before deletion
+    # Delete all temporary holds (keep permanent ones); the row count of
+    # the DELETE is the number released
     temp_holds_count = db.query(NumberHold).filter(
         NumberHold.is_permanent == False
-    ).count()
-    
-    # Delete all temporary holds (keep permanent ones)
-    db.query(NumberHold).filter(
-        NumberHold.is_permanent == False
-    ).delete()
+    ).delete(synchronize_session=False)
     db.commit()
+    invalidate_admin_stats()
+    clear_holds_caches(context.application)
     
     await query.answer(f"✅ Released {temp_holds_count} temporary holds", show_alert=True)
     
@@ -1055,10 +1185,11 @@ async def make_admin_callback(query, context, db, db_user, target_user_id):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    target_user = db.query(User).filter_by(id=target_user_id).first()
+    target_user = get_user_by_id(db, target_user_id)
     if target_user:
         target_user.is_admin = True
         db.commit()
+        cache_admin_flag(db, target_user.telegram_id, True)
         log_access(db, db_user, f"make_admin_{target_user.telegram_id}")
         await query.answer(f"✅ User {target_user.telegram_id} is now an admin")
     else:
@@ -1079,10 +1210,11 @@ async def remove_admin_callback(query, context, db, db_user, target_user_id):
         await query.answer("❌ You cannot remove your own admin status")
         return
     
-    target_user = db.query(User).filter_by(id=target_user_id).first()
+    target_user = get_user_by_id(db, target_user_id)
     if target_user:
         target_user.is_admin = False
         db.commit()
+        cache_admin_flag(db, target_user.telegram_id, False)
         log_access(db, db_user, f"remove_admin_{target_user.telegram_id}")
         await query.answer(f"✅ Removed admin status from user {target_user.telegram_id}")
     else:
@@ -1192,7 +1324,7 @@ async def admin_manage_bans_callback(query, context, db, db_user):
     keyboard = []
     for user in users:
         ban_badge = "🚫" if user.is_banned else "✅"
-        username_str = f"@{user.username}" if user.username else f"ID:{user.telegram_id}"
+        username_str = user.display_handle
         button_text = f"{ban_badge} {username_str}"
         
         if user.is_banned:
@@ -1214,7 +1346,7 @@ async def ban_user_callback(query, context, db, db_user, target_user_id):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    target_user = db.query(User).filter_by(id=target_user_id).first()
+    target_user = get_user_by_id(db, target_user_id)
     if target_user:
         # Don't allow banning admins
         if target_user.is_admin:
@@ -1238,7 +1370,7 @@ async def unban_user_callback(query, context, db, db_user, target_user_id):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    target_user = db.query(User).filter_by(id=target_user_id).first()
+    target_user = get_user_by_id(db, target_user_id)
     if target_user:
         target_user.is_banned = False
         db.commit()
@@ -1267,7 +1399,7 @@ async def admin_manage_balance_callback(query, context, db, db_user):
     
     keyboard = []
     for user in users:
-        username_str = f"@{user.username}" if user.username else f"ID:{user.telegram_id}"
+        username_str = user.display_handle
         button_text = f"{username_str} - ${user.balance:.2f}"
         keyboard.append([
             InlineKeyboardButton(f"➕ {button_text}", callback_data=f"select_add_balance_{user.id}"),
@@ -1289,16 +1421,15 @@ async def add_balance_prompt_callback(query, context, db, db_user, target_user_i
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    target_user = db.query(User).filter_by(id=target_user_id).first()
+    target_user = get_user_by_id(db, target_user_id)
     if not target_user:
         await query.answer("❌ User not found", show_alert=True)
         return
     
     # Store target user ID in user_data for next message
-    context.user_data['admin_action'] = 'add_balance'
-    context.user_data['target_user_id'] = target_user_id
+    start_admin_session(context, 'add_balance', target_user_id=target_user_id)
     
-    username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
+    username_str = target_user.display_handle
     message = (
         f"💰 <b>Add Balance to {username_str}</b>\n\n"
         f"Current balance: ${target_user.balance:.2f}\n\n"
@@ -1317,16 +1448,15 @@ async def deduct_balance_prompt_callback(query, context, db, db_user, target_use
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    target_user = db.query(User).filter_by(id=target_user_id).first()
+    target_user = get_user_by_id(db, target_user_id)
     if not target_user:
         await query.answer("❌ User not found", show_alert=True)
         return
     
     # Store target user ID in user_data for next message
-    context.user_data['admin_action'] = 'deduct_balance'
-    context.user_data['target_user_id'] = target_user_id
+    start_admin_session(context, 'deduct_balance', target_user_id=target_user_id)
     
-    username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
+    username_str = target_user.display_handle
     message = (
         f"💰 <b>Deduct Balance from {username_str}</b>\n\n"
         f"Current balance: ${target_user.balance:.2f}\n\n"
@@ -1347,31 +1477,37 @@ async def admin_recharge_requests_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_recharge_requests")
     
-    # Get pending recharge requests
-    pending_requests = db.query(RechargeRequest).filter_by(status='pending').order_by(RechargeRequest.created_at.desc()).limit(10).all()
+    # Get pending recharge requests together with their users in one query
+    pending_requests = db.query(RechargeRequest, User).join(
+        User, User.id == RechargeRequest.user_id
+    ).filter(
+        RechargeRequest.status == 'pending'
+    ).order_by(RechargeRequest.created_at.desc()).limit(10).all()
     
-    message = "💳 <b>Recharge Requests</b>\n\n"
+    parts = ["💳 <b>Recharge Requests</b>\n\n"]
     
     if not pending_requests:
-        message += "No pending recharge requests.\n\n"
-        message += "Users can request recharges from the main menu.\n"
-        message += "Contact information will be shown to them."
+        parts.append(
+            "No pending recharge requests.\n\n"
+            "Users can request recharges from the main menu.\n"
+            "Contact information will be shown to them."
+        )
         keyboard = [[InlineKeyboardButton("⬅️ Back to Admin Panel", callback_data="admin_back")]]
     else:
-        message += f"Pending requests: {len(pending_requests)}\n\n"
+        parts.append(f"Pending requests: {len(pending_requests)}\n\n")
         
-        for req in pending_requests:
-            req_user = db.query(User).filter_by(id=req.user_id).first()
-            username_str = f"@{req_user.username}" if req_user.username else f"ID:{req_user.telegram_id}"
-            message += f"📝 {username_str} - ${req.amount:.2f}\n"
-            message += f"   Requested: {req.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+        for req, req_user in pending_requests:
+            username_str = req_user.display_handle
+            parts.append(f"📝 {username_str} - ${req.amount:.2f}\n")
+            parts.append(f"   Requested: {req.created_at.strftime('%Y-%m-%d %H:%M')}\n\n")
         
-        message += "\n💡 Process recharges manually by using 'Manage Balance' option."
+        parts.append("\n💡 Process recharges manually by using 'Manage Balance' option.")
         keyboard = [
             [InlineKeyboardButton("💰 Manage Balance", callback_data="admin_manage_balance")],
             [InlineKeyboardButton("⬅️ Back to Admin Panel", callback_data="admin_back")]
         ]
     
+    message = "".join(parts)
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='HTML')
 
@@ -1404,8 +1540,8 @@ async def admin_price_ranges_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_price_ranges")
     
-    # Get all price ranges
-    price_ranges = db.query(PriceRange).order_by(PriceRange.created_at.desc()).limit(10).all()
+    # Get the latest price ranges; only the name and price are shown
+    price_ranges = get_latest_price_ranges(db, limit=10)
     
     message = "💵 <b>SMS Price Ranges</b>\n\n"
     
@@ -1413,7 +1549,7 @@ async def admin_price_ranges_callback(query, context, db, db_user):
         message += "No price ranges configured.\n\n"
     else:
         for pr in price_ranges:
-            message += f"📍 Range: <code>{pr.range_pattern}</code>\n"
+            message += f"📍 Range: <code>{escape_html(pr.range_name)}</code>\n"
             message += f"   Price: ${pr.price:.2f}\n\n"
     
     message += "Select an option below:"
@@ -1433,7 +1569,7 @@ async def add_balance_by_id_prompt_callback(query, context, db, db_user):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    context.user_data['admin_action'] = 'add_balance_by_id_step1'
+    start_admin_session(context, 'add_balance_by_id_step1')
     
     message = (
         "💰 <b>Add Balance by User ID</b>\n\n"
@@ -1452,7 +1588,7 @@ async def deduct_balance_by_id_prompt_callback(query, context, db, db_user):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    context.user_data['admin_action'] = 'deduct_balance_by_id_step1'
+    start_admin_session(context, 'deduct_balance_by_id_step1')
     
     message = (
         "💰 <b>Deduct Balance by User ID</b>\n\n"
@@ -1465,6 +1601,21 @@ async def deduct_balance_by_id_prompt_callback(query, context, db, db_user):
     await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='HTML')
 
 
+def _price_range_button_text(item):
+    """Button label for a range returned by the SMS ranges API."""
+    if isinstance(item, dict):
+        title = item.get('title', '')
+        
+        if title:
+            return f"{title[:MAX_TITLE_LENGTH]}" if len(title) > MAX_TITLE_LENGTH else title
+        info = " - ".join(f"{k}: {v}" for k, v in islice(item.items(), 2))
+        return info[:MAX_BUTTON_TEXT_LENGTH]
+    elif isinstance(item, list):
+        info = " | ".join(str(x) for x in item[:2])
+        return info[:MAX_BUTTON_TEXT_LENGTH]
+    return str(item)[:MAX_BUTTON_TEXT_LENGTH]
+
+
 async def select_range_for_price_callback(query, context, db, db_user):
     """Show available SMS ranges for price setting (admin only)."""
     if not is_user_admin(db, db_user.telegram_id):
@@ -1473,9 +1624,9 @@ async def select_range_for_price_callback(query, context, db, db_user):
     
     log_access(db, db_user, "select_range_for_price")
     
-    # Get scrapper session and fetch ranges
+    # Get scrapper session and fetch ranges without blocking the event loop
     scrapper = get_scrapper_session()
-    data = scrapper.get_sms_ranges(max_results=20, page=1)
+    data = await asyncio.to_thread(scrapper.get_sms_ranges, max_results=20, page=1)
     
     if not data:
         error_msg = (
@@ -1513,36 +1664,15 @@ async def select_range_for_price_callback(query, context, db, db_user):
     message += f"Available SMS Ranges ({len(ranges)}):\n"
     message += "Click on a range to set its price.\n\n"
     
-    # Create keyboard with range buttons
-    keyboard = []
+    # Range data for later, keyed by the range's position in this list
+    price_ranges_data = context.chat_data.setdefault('price_ranges_data', {})
+    price_ranges_data.update(enumerate(ranges, 1))
     
-    for i, item in enumerate(ranges, 1):
-        button_text = ""
-        range_id = None
-        
-        if isinstance(item, dict):
-            range_id = item.get('id') or item.get('range_id') or str(i)
-            title = item.get('title', '')
-            
-            if title:
-                button_text = f"{title[:MAX_TITLE_LENGTH]}" if len(title) > MAX_TITLE_LENGTH else title
-            else:
-                info = " - ".join(f"{k}: {v}" for k, v in list(item.items())[:2])
-                button_text = info[:MAX_BUTTON_TEXT_LENGTH]
-        elif isinstance(item, list):
-            range_id = str(i)
-            info = " | ".join(str(x) for x in item[:2])
-            button_text = info[:MAX_BUTTON_TEXT_LENGTH]
-        else:
-            range_id = str(i)
-            button_text = str(item)[:MAX_BUTTON_TEXT_LENGTH]
-        
-        # Store range data for later
-        if 'price_ranges_data' not in context.chat_data:
-            context.chat_data['price_ranges_data'] = {}
-        context.chat_data['price_ranges_data'][str(range_id)] = item
-        
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"set_price_for_range_{range_id}")])
+    # Create keyboard with range buttons
+    keyboard = [
+        [InlineKeyboardButton(_price_range_button_text(item), callback_data=f"set_price_for_range_{i}")]
+        for i, item in enumerate(ranges, 1)
+    ]
     
     keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_price_ranges")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1550,16 +1680,19 @@ async def select_range_for_price_callback(query, context, db, db_user):
     await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='HTML')
 
 
-async def set_price_for_range_callback(query, context, db, db_user, range_id):
+async def set_price_for_range_callback(query, context, db, db_user, range_index):
     """Prompt admin to set price for a specific range."""
     if not is_user_admin(db, db_user.telegram_id):
         await query.answer("❌ Admin access required", show_alert=True)
         return
     
-    # Get range data
-    range_data = None
-    if 'price_ranges_data' in context.chat_data:
-        range_data = context.chat_data['price_ranges_data'].get(str(range_id))
+    # Get range data stored by the range list
+    range_data = context.chat_data.get('price_ranges_data', {}).get(range_index)
+    
+    # Ranges from the API carry their own ID; otherwise use the list position
+    range_id = str(range_index)
+    if isinstance(range_data, dict):
+        range_id = range_data.get('id') or range_data.get('range_id') or range_id
     
     # Extract range title/name
     range_name = range_id
@@ -1570,13 +1703,12 @@ async def set_price_for_range_callback(query, context, db, db_user, range_id):
             range_name = str(range_data[0])
     
     # Check if price already exists for this range
-    existing = db.query(PriceRange).filter_by(range_pattern=range_id).first()
-    current_price = existing.price if existing else None
+    current_price = get_set_price(db, range_id)
     
     # Store range ID for later
-    context.user_data['admin_action'] = 'set_price_for_specific_range'
-    context.user_data['selected_range_id'] = range_id
-    context.user_data['selected_range_name'] = range_name
+    start_admin_session(
+        context, 'set_price_for_specific_range', selected_range_id=range_id, selected_range_name=range_name
+    )
     
     message = (
         f"💵 <b>Set Price for Range</b>\n\n"
@@ -1598,13 +1730,29 @@ async def set_price_for_range_callback(query, context, db, db_user, range_id):
 
 def is_phone_number(text):
     """Check if the text is a valid phone number."""
-    # Remove any whitespace or special characters
-    cleaned = re.sub(r'[^\d+]', '', text)
-    
-    # Check if it's a valid phone number (at least 10 digits, optionally starting with +)
-    # Pattern: optional +, then 10-15 digits
-    pattern = r'^\+?\d{10,15}$'
-    return bool(re.match(pattern, cleaned))
+    # Users often resend the same number, so results are memoised in a
+    # bounded per-process LRU cache; surrounding whitespace never matters
+    return _is_phone_number_impl(text.strip())
+
+
+@lru_cache(maxsize=4096)
+def _is_phone_number_impl(text):
+    """Uncached phone number check used by is_phone_number."""
+    # Single pass equivalent of stripping everything but digits and + and
+    # matching an optional +, then 10-15 digits; other characters are ignored
+    digit_count = 0
+    seen_plus = False
+    for char in text:
+        if char.isdecimal():
+            digit_count += 1
+            if digit_count > 15:
+                return False
+        elif char == '+':
+            # Only a single + before the first digit is allowed
+            if digit_count or seen_plus:
+                return False
+            seen_plus = True
+    return digit_count >= 10
 
 
 def is_stats_row(row):
@@ -1627,8 +1775,15 @@ def is_stats_row(row):
     if not isinstance(first_field, str):
         return False
     
-    # Stats rows have comma-separated values with percentage signs
-    return ',' in first_field and '%' in first_field
+    # Stats rows start with a number followed by a comma early on, which
+    # rejects timestamps like "2024-11-05 10:00:00" after a few characters;
+    # only stats-shaped fields are scanned for a percentage sign
+    return (
+        len(first_field) > 4
+        and first_field[0].isdigit()
+        and ',' in first_field[:12]
+        and '%' in first_field
+    )
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1638,42 +1793,32 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     text = message.text.strip()
-    db = get_db_session()
     
-    try:
-        user = get_or_create_user(
-            db,
-            telegram_id=message.from_user.id,
-            username=message.from_user.username or message.from_user.first_name
-        )
-        
-        # Check for admin actions first
-        admin_action = context.user_data.get('admin_action')
-        if admin_action and is_user_admin(db, user.telegram_id):
-            # Handle admin input
-            await handle_admin_input(update, context)
-            return
-        
-        # Check if the message is a phone number
-        if not is_phone_number(text):
-            return
-        
-        # Handle phone search
-        await handle_phone_search(update, context)
-    finally:
-        db.close()
+    # Both handlers below load the user themselves, so text that is neither
+    # admin input nor a phone number never touches the database
+    
+    # Check for admin actions first, handle_admin_input verifies admin status
+    if get_admin_session(context).action:
+        await handle_admin_input(update, context)
+        return
+    
+    # Check if the message is a phone number
+    if not is_phone_number(text):
+        return
+    
+    # Handle phone search with the number cleaned once here
+    await handle_phone_search(update, context, PHONE_CLEAN_RE.sub('', text))
 
 
-async def handle_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE, phone_number=None):
     """Handle phone number search when user sends a phone number."""
     message = update.message
     if not message or not message.text:
         return
     
-    text = message.text.strip()
-    
-    # Extract clean phone number
-    phone_number = re.sub(r'[^\d+]', '', text)
+    # Extract clean phone number unless the caller already did
+    if phone_number is None:
+        phone_number = PHONE_CLEAN_RE.sub('', message.text.strip())
     
     # Get database session
     db = get_db_session()
@@ -1698,10 +1843,7 @@ async def handle_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
         
         # Check if this number is held by the user
-        held_number = db.query(NumberHold).filter_by(
-            user_id=user.id,
-            phone_number_str=phone_number
-        ).first()
+        held_number = get_held_number(context, db, user, phone_number)
         
         if not held_number:
             await message.reply_text(
@@ -1711,8 +1853,10 @@ async def handle_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
         
         # Update first retry time if not set
-        if not held_number.first_retry_time:
-            update_first_retry_time(db, user, phone_number)
+        if not held_number['first_retry_time']:
+            now = datetime.utcnow()
+            update_first_retry_time(db, user, phone_number, now)
+            held_number['first_retry_time'] = now
         
         # Log the search
         log_access(db, user, f"SMS search: {phone_number}")
@@ -1723,128 +1867,261 @@ async def handle_phone_search(update: Update, context: ContextTypes.DEFAULT_TYPE
             parse_mode='HTML'
         )
         
-        try:
-            # Get scrapper session
-            scrapper = get_scrapper_session()
-            
-            # Search for SMS messages
-            data = scrapper.get_sms_messages(phone_number)
-            
-            if not data:
-                await searching_msg.edit_text(
+        # Let the slow part run in the background so this update finishes
+        # right away and the next one can be processed
+        context.application.create_task(_sms_search_task(
+            searching_msg.edit_text, user.id, held_number, phone_number,
+            offer_retry=False, error_label="phone search"
+        ))
+    finally:
+        db.close()
+
+
+async def _sms_search_task(edit_text, user_id, held_number, phone_number, offer_retry, error_label):
+    """
+    Run an SMS search in the background with its own database session.
+    
+    Searches for the same user and number are serialised, so a double
+    click cannot charge for one hold twice.
+    """
+    key = (user_id, phone_number)
+    entry = _sms_search_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            db = get_db_session()
+            try:
+                user = get_user_by_id(db, user_id)
+                await _do_sms_search(
+                    edit_text, db, user, held_number, phone_number,
+                    offer_retry=offer_retry, error_label=error_label
+                )
+            finally:
+                db.close()
+    finally:
+        # Drop the lock once nobody is using or waiting for it
+        entry[1] -= 1
+        if not entry[1]:
+            del _sms_search_locks[key]
+
+
+async def _do_sms_search(edit_text, db, user, held_number, phone_number, offer_retry, error_label):
+    """
+    Fetch SMS messages for a held number, charge for it and show the result.
+    
+    Shared by the text message search and the search/retry buttons.
+    
+    Args:
+        edit_text: Coroutine that edits the "searching" message
+            (Message.edit_text or CallbackQuery.edit_message_text)
+        db: Database session
+        user: User who holds the number
+        held_number: The user's hold on phone_number, as returned by
+            get_held_number
+        phone_number: Phone number to search for
+        offer_retry: Whether failures show a Retry button
+        error_label: Context used when logging unexpected errors
+    """
+    # Keyboard offering another attempt for this number
+    retry_markup = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
+            InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
+        ]
+    ])
+    
+    try:
+        # Get scrapper session
+        scrapper = get_scrapper_session()
+        
+        # Search for SMS messages; the HTTP request blocks, so run it in a
+        # worker thread to keep other updates moving
+        data = await asyncio.to_thread(scrapper.get_sms_messages, phone_number)
+        
+        if not data:
+            if offer_retry:
+                await edit_text(
+                    "❌ Failed to retrieve SMS messages. Please try again.",
+                    reply_markup=retry_markup
+                )
+            else:
+                await edit_text(
                     "❌ Failed to retrieve SMS messages. Please try again later."
                 )
+            return
+        
+        # Parse response
+        messages = data.get('aaData', [])
+        
+        # Filter out the stats row
+        actual_messages = [
+            msg for msg in messages
+            if isinstance(msg, list) and len(msg) >= 6 and not is_stats_row(msg)
+        ]
+        
+        if not actual_messages:
+            await edit_text(
+                f"📭 No SMS messages found for <code>{escape_html(phone_number)}</code>",
+                parse_mode='HTML',
+                reply_markup=retry_markup
+            )
+            return
+        
+        # SMS found! Mark as permanent and deduct balance
+        was_temporary = not held_number['is_permanent']
+        price = 0.0
+        
+        if was_temporary:
+            # The cached hold may be stale (released or charged elsewhere),
+            # so charging always goes by the current row
+            hold = db.query(NumberHold).filter_by(
+                user_id=user.id,
+                phone_number_str=phone_number
+            ).first()
+            if not hold:
+                await edit_text("❌ This number is no longer held by you.")
                 return
+            was_temporary = not hold.is_permanent
+            held_number['is_permanent'] = hold.is_permanent
+        
+        if was_temporary:
+            # Get price for this range
+            price = get_price_for_range(db, hold.range_id)
             
-            # Parse response
-            total_records = data.get('iTotalRecords', '0')
-            if isinstance(total_records, str):
-                total_records = int(total_records) if total_records.isdigit() else 0
-            
-            messages = data.get('aaData', [])
-            
-            # Filter out the stats row using helper function
-            actual_messages = []
-            for msg in messages:
-                if isinstance(msg, list) and len(msg) >= 6:
-                    if not is_stats_row(msg):
-                        actual_messages.append(msg)
+            # Deduct balance and mark as permanent hold in one commit
+            new_balance = await asyncio.to_thread(
+                charge_for_sms, db, user.id, phone_number, price,
+                description=f"SMS received on {phone_number}"
+            )
             
-            if not actual_messages:
-                # Create keyboard with retry button
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                        InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await searching_msg.edit_text(
-                    f"📭 No SMS messages found for <code>{escape_html(phone_number)}</code>",
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
+            if new_balance is None:
+                await edit_text(
+                    "❌ Insufficient balance to complete this transaction."
                 )
                 return
             
-            # SMS found! Mark as permanent and deduct balance
-            was_temporary = not held_number.is_permanent
-            price = 0.0
+            if new_balance is SMS_ALREADY_CHARGED:
+                # Charged elsewhere (e.g. by the auto-fetch job) meanwhile
+                was_temporary = False
+                price = 0.0
             
-            if was_temporary:
-                # Get price for this range
-                price = get_price_for_range(db, held_number.range_id)
-                
-                # Deduct balance
-                new_balance = deduct_user_balance(
-                    db, user, price, 
-                    transaction_type='sms_charge',
-                    description=f"SMS received on {phone_number}"
-                )
-                
-                if new_balance is None:
-                    await searching_msg.edit_text(
-                        "❌ Insufficient balance to complete this transaction."
-                    )
-                    return
-                
-                # Mark as permanent hold
-                mark_number_permanent(db, user, phone_number)
-            
-            # Format messages
-            message_text = f"📱 <b>SMS Messages for {escape_html(phone_number)}</b>\n"
-            message_text += f"Found {len(actual_messages)} message(s)\n"
-            
-            # Show balance deduction info if it was just deducted
-            if was_temporary:
-                message_text += f"\n💸 Balance deducted: ${price:.2f}\n"
-                message_text += f"💰 New balance: ${user.balance:.2f}\n"
-            
-            message_text += "\n"
-            
-            for i, msg_data in enumerate(actual_messages, 1):
-                time = msg_data[0] if len(msg_data) > 0 else "N/A"
-                sender_id = msg_data[3] if len(msg_data) > 3 else "N/A"
-                sms_body = msg_data[5] if len(msg_data) > 5 else "N/A"
-                
-                # Clean up None values
-                if sender_id is None:
-                    sender_id = "Unknown"
-                if sms_body is None:
-                    sms_body = "(empty)"
-                
-                # Escape HTML in the content
-                time_escaped = escape_html(str(time))
-                sender_escaped = escape_html(str(sender_id))
-                body_escaped = escape_html(str(sms_body))
-                
-                message_text += f"<b>Message {i}:</b>\n"
-                message_text += f"🕒 <b>Time:</b> {time_escaped}\n"
-                message_text += f"📨 <b>Sender:</b> {sender_escaped}\n"
-                message_text += f"💬 <b>Message:</b>\n<pre>{body_escaped}</pre>\n\n"
-                
-                # Telegram has a message length limit, so split if needed
-                if len(message_text) > MAX_TELEGRAM_MESSAGE_LENGTH:
-                    message_text += f"<i>... and {len(actual_messages) - i} more message(s)</i>"
-                    break
-            
-            # Create keyboard with back button
-            keyboard = [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await searching_msg.edit_text(
-                message_text,
-                parse_mode='HTML',
-                reply_markup=reply_markup
+            held_number['is_permanent'] = True
+        
+        message_text = _format_sms_messages(
+            actual_messages, phone_number, was_temporary, price, user.balance
+        )
+        
+        # Create keyboard with back button
+        keyboard = [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await edit_text(
+            message_text,
+            parse_mode='HTML',
+            reply_markup=reply_markup
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in {error_label}: {e}")
+        if offer_retry:
+            await edit_text(
+                "❌ An error occurred while searching for SMS messages. Please try again.",
+                reply_markup=retry_markup
             )
-            
-        except Exception as e:
-            logger.error(f"Error in phone search: {e}")
-            await searching_msg.edit_text(
+        else:
+            await edit_text(
                 "❌ An error occurred while searching for SMS messages. Please try again later."
             )
-    finally:
-        db.close()
+
+
+def _format_sms_messages(actual_messages, phone_number, was_temporary, price, balance):
+    """Format SMS messages as HTML, truncated to fit in one Telegram message."""
+    parts = [
+        f"📱 <b>SMS Messages for {escape_html(phone_number)}</b>\n",
+        f"Found {len(actual_messages)} message(s)\n"
+    ]
+    
+    # Show balance deduction info if it was just deducted
+    if was_temporary:
+        parts.append(f"\n💸 Balance deducted: ${price:.2f}\n")
+        parts.append(f"💰 New balance: ${balance:.2f}\n")
+    
+    parts.append("\n")
+    
+    # Space left for message blocks, counted down as parts are added
+    # instead of re-measuring the text
+    remaining = MAX_TELEGRAM_MESSAGE_LENGTH - sum(map(len, parts))
+    
+    for i, msg_data in enumerate(actual_messages, 1):
+        time = msg_data[0] if len(msg_data) > 0 else "N/A"
+        sender_id = msg_data[3] if len(msg_data) > 3 else "N/A"
+        sms_body = msg_data[5] if len(msg_data) > 5 else "N/A"
+        
+        # Clean up None values
+        if sender_id is None:
+            sender_id = "Unknown"
+        if sms_body is None:
+            sms_body = "(empty)"
+        
+        # Escape HTML in the content
+        time_escaped = escape_html(str(time))
+        sender_escaped = escape_html(sender_id)
+        body_escaped = escape_html(sms_body)
+        
+        part = (
+            f"<b>Message {i}:</b>\n"
+            f"🕒 <b>Time:</b> {time_escaped}\n"
+            f"📨 <b>Sender:</b> {sender_escaped}\n"
+            f"💬 <b>Message:</b>\n<pre>{body_escaped}</pre>\n\n"
+        )
+        parts.append(part)
+        remaining -= len(part)
+        
+        # Telegram has a message length limit, so split if needed
+        if remaining < 0:
+            parts.append(f"<i>... and {len(actual_messages) - i} more message(s)</i>")
+            break
+    
+    return "".join(parts)
+
+
+# Per (user id, phone number) lock and its user count, see _sms_search_task
+_sms_search_locks = {}
+
+
+def cache_held_numbers(context, holds):
+    """Remember the user's holds so repeated SMS checks can skip the database."""
+    expires_at = monotonic() + HOLDS_CACHE_TTL
+    holds_cache = context.user_data.setdefault('holds_cache', {})
+    for hold in holds:
+        holds_cache[hold.phone_number_str] = (expires_at, {
+            'is_permanent': hold.is_permanent,
+            'range_id': hold.range_id,
+            'first_retry_time': hold.first_retry_time
+        })
+
+
+def get_held_number(context, db, user, phone_number):
+    """Get the user's hold on a number as a dict, or None if it isn't held."""
+    cached = context.user_data.get('holds_cache', {}).get(phone_number)
+    if cached and cached[0] > monotonic():
+        return cached[1]
+    
+    hold = db.query(NumberHold).filter_by(
+        user_id=user.id,
+        phone_number_str=phone_number
+    ).first()
+    if not hold:
+        return None
+    
+    cache_held_numbers(context, [hold])
+    return context.user_data['holds_cache'][phone_number][1]
+
+
+def clear_holds_caches(application):
+    """Drop every user's cached holds after holds are released."""
+    for user_data in application.user_data.values():
+        user_data.pop('holds_cache', None)
 
 
 async def check_sms_callback(query, context, db, db_user, range_unique_id):
@@ -1863,6 +2140,13 @@ async def check_sms_callback(query, context, db, db_user, range_unique_id):
     
     numbers = context.user_data['selected_numbers'][range_unique_id]
     
+    # Load all of these holds in one query so the searches that usually
+    # follow don't each need their own lookup
+    cache_held_numbers(context, db.query(NumberHold).filter(
+        NumberHold.user_id == db_user.id,
+        NumberHold.phone_number_str.in_(numbers)
+    ).all())
+    
     # Create message with all numbers and instructions
     message = f"📱 <b>Check SMS for Numbers</b>\n\n"
     message += f"Your {len(numbers)} held numbers:\n\n"
@@ -1875,12 +2159,10 @@ async def check_sms_callback(query, context, db, db_user, range_unique_id):
     message += "Or click a button below to search for a specific number:"
     
     # Create keyboard with buttons for each number (max 20)
-    keyboard = []
-    for phone_number in numbers[:20]:  # Limit to 20 buttons
-        keyboard.append([InlineKeyboardButton(
-            f"🔍 {phone_number}", 
-            callback_data=f"search_sms_{phone_number}"
-        )])
+    keyboard = [
+        [InlineKeyboardButton(f"🔍 {phone_number}", callback_data=f"search_sms_{phone_number}")]
+        for phone_number in numbers[:20]  # Limit to 20 buttons
+    ]
     
     # Add navigation buttons
     keyboard.append([
@@ -1897,24 +2179,26 @@ async def check_sms_callback(query, context, db, db_user, range_unique_id):
     )
 
 
-async def search_sms_callback(query, context, db, db_user, phone_number):
+async def search_sms_callback(query, context, db, db_user, phone_number, is_retry=False):
     """Search for SMS messages for a specific phone number (from button click)."""
     # Check if this number is held by the user
-    held_number = db.query(NumberHold).filter_by(
-        user_id=db_user.id,
-        phone_number_str=phone_number
-    ).first()
+    held_number = get_held_number(context, db, db_user, phone_number)
     
     if not held_number:
         await query.answer("❌ This number is not held by you.", show_alert=True)
         return
     
     # Update first retry time if not set
-    if not held_number.first_retry_time:
-        update_first_retry_time(db, db_user, phone_number)
+    if not held_number['first_retry_time']:
+        now = datetime.utcnow()
+        update_first_retry_time(db, db_user, phone_number, now)
+        held_number['first_retry_time'] = now
     
     # Log the search
-    log_access(db, db_user, f"SMS search: {phone_number}")
+    if is_retry:
+        log_access(db, db_user, f"SMS search retry: {phone_number}")
+    else:
+        log_access(db, db_user, f"SMS search: {phone_number}")
     
     # Show searching message
     await query.edit_message_text(
@@ -1922,317 +2206,199 @@ async def search_sms_callback(query, context, db, db_user, phone_number):
         parse_mode='HTML'
     )
     
-    try:
-        # Get scrapper session
-        scrapper = get_scrapper_session()
-        
-        # Search for SMS messages
-        data = scrapper.get_sms_messages(phone_number)
-        
-        if not data:
-            # Create keyboard with retry button
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                    InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "❌ Failed to retrieve SMS messages. Please try again.",
-                reply_markup=reply_markup
-            )
-            return
-        
-        # Parse response
-        total_records = data.get('iTotalRecords', '0')
-        if isinstance(total_records, str):
-            total_records = int(total_records) if total_records.isdigit() else 0
-        
-        messages = data.get('aaData', [])
-        
-        # Filter out the stats row
-        actual_messages = []
-        for msg in messages:
-            if isinstance(msg, list) and len(msg) >= 6:
-                if not is_stats_row(msg):
-                    actual_messages.append(msg)
-        
-        if not actual_messages:
-            # Create keyboard with retry button
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                    InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"📭 No SMS messages found for <code>{escape_html(phone_number)}</code>",
-                parse_mode='HTML',
-                reply_markup=reply_markup
-            )
-            return
-        
-        # SMS found! Mark as permanent and deduct balance
-        was_temporary = not held_number.is_permanent
-        price = 0.0
-        
-        if was_temporary:
-            # Get price for this range
-            price = get_price_for_range(db, held_number.range_id)
-            
-            # Deduct balance
-            new_balance = deduct_user_balance(
-                db, db_user, price, 
-                transaction_type='sms_charge',
-                description=f"SMS received on {phone_number}"
-            )
-            
-            if new_balance is None:
-                await query.edit_message_text(
-                    "❌ Insufficient balance to complete this transaction."
-                )
-                return
-            
-            # Mark as permanent hold
-            mark_number_permanent(db, db_user, phone_number)
-        
-        # Format messages
-        message_text = f"📱 <b>SMS Messages for {escape_html(phone_number)}</b>\n"
-        message_text += f"Found {len(actual_messages)} message(s)\n"
-        
-        # Show balance deduction info if it was just deducted
-        if was_temporary:
-            message_text += f"\n💸 Balance deducted: ${price:.2f}\n"
-            message_text += f"💰 New balance: ${db_user.balance:.2f}\n"
-        
-        message_text += "\n"
-        
-        for i, msg_data in enumerate(actual_messages, 1):
-            time = msg_data[0] if len(msg_data) > 0 else "N/A"
-            sender_id = msg_data[3] if len(msg_data) > 3 else "N/A"
-            sms_body = msg_data[5] if len(msg_data) > 5 else "N/A"
-            
-            # Clean up None values
-            if sender_id is None:
-                sender_id = "Unknown"
-            if sms_body is None:
-                sms_body = "(empty)"
-            
-            # Escape HTML in the content
-            time_escaped = escape_html(str(time))
-            sender_escaped = escape_html(str(sender_id))
-            body_escaped = escape_html(str(sms_body))
-            
-            message_text += f"<b>Message {i}:</b>\n"
-            message_text += f"🕒 <b>Time:</b> {time_escaped}\n"
-            message_text += f"📨 <b>Sender:</b> {sender_escaped}\n"
-            message_text += f"💬 <b>Message:</b>\n<pre>{body_escaped}</pre>\n\n"
-            
-            # Telegram has a message length limit, so split if needed
-            if len(message_text) > MAX_TELEGRAM_MESSAGE_LENGTH:
-                message_text += f"<i>... and {len(actual_messages) - i} more message(s)</i>"
-                break
-        
-        # Create keyboard with back button
-        keyboard = [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            message_text,
-            parse_mode='HTML',
-            reply_markup=reply_markup
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in SMS search: {e}")
-        # Create keyboard with retry button
-        keyboard = [
-            [
-                InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "❌ An error occurred while searching for SMS messages. Please try again.",
-            reply_markup=reply_markup
-        )
+    context.application.create_task(_sms_search_task(
+        query.edit_message_text, db_user.id, held_number, phone_number,
+        offer_retry=True, error_label="SMS retry" if is_retry else "SMS search"
+    ))
 
 
 async def retry_sms_callback(query, context, db, db_user):
     """Handle retry button for SMS search."""
     # Extract phone number from callback data (format: retry_sms_PHONENUMBER)
     phone_number = query.data.replace("retry_sms_", "")
+    await search_sms_callback(query, context, db, db_user, phone_number, is_retry=True)
+
+
+async def admin_balance_target_input(message, context, db, user, text, next_action, heading, prompt):
+    """Resolve the Telegram user ID sent by an admin and ask for an amount."""
+    try:
+        target_telegram_id = int(text)
+    except ValueError:
+        await message.reply_text("❌ Invalid user ID. Please send a valid number:")
+        return
     
-    # Check if this number is held by the user
-    held_number = db.query(NumberHold).filter_by(
-        user_id=db_user.id,
-        phone_number_str=phone_number
-    ).first()
+    # Find user
+    target_user = get_user_by_telegram_id(db, target_telegram_id)
+    if not target_user:
+        await message.reply_text(f"❌ User with ID {target_telegram_id} not found.")
+        end_admin_session(context)
+        return
     
-    if not held_number:
-        await query.answer("❌ This number is not held by you.", show_alert=True)
+    # Ask for amount
+    start_admin_session(
+        context, next_action,
+        target_telegram_id=target_telegram_id, target_user_id=target_user.id
+    )
+    
+    username_str = target_user.display_handle
+    await message.reply_text(
+        f"💰 <b>{heading} {username_str}</b>\n\n"
+        f"Current balance: ${target_user.balance:.2f}\n\n"
+        f"{prompt}",
+        parse_mode='HTML'
+    )
+
+
+async def admin_add_balance_input(message, context, db, user, text):
+    """Add the amount sent by an admin to the selected user's balance."""
+    amount = parse_positive_amount(text)
+    if amount is None:
+        await message.reply_text("❌ Invalid amount. Please send a positive number (e.g., 100 or 50.5):")
         return
     
-    # Update first retry time if not set
-    if not held_number.first_retry_time:
-        update_first_retry_time(db, db_user, phone_number)
+    target_user = get_user_by_id(db, get_admin_session(context).target_user_id)
+    if not target_user:
+        await message.reply_text("❌ User not found.")
+        end_admin_session(context)
+        return
     
-    # Log the retry
-    log_access(db, db_user, f"SMS search retry: {phone_number}")
+    # Add balance
+    new_balance = await asyncio.to_thread(
+        add_user_balance, db, target_user, amount,
+        transaction_type='admin_add',
+        description=f"Admin added by {user.telegram_id}",
+        logged_by=user,
+        action=f"add_balance_{target_user.telegram_id}_{amount}"
+    )
     
-    # Show searching message
-    await query.edit_message_text(
-        f"🔍 Searching SMS messages for <code>{escape_html(phone_number)}</code>...",
+    username_str = target_user.display_handle
+    await message.reply_text(BALANCE_ADDED_TEMPLATE(amount, username_str, new_balance))
+    
+    end_admin_session(context)
+
+
+async def admin_deduct_balance_input(message, context, db, user, text):
+    """Deduct the amount sent by an admin from the selected user's balance."""
+    amount = parse_positive_amount(text)
+    if amount is None:
+        await message.reply_text("❌ Invalid amount. Please send a positive number (e.g., 10 or 5.5):")
+        return
+    
+    target_user = get_user_by_id(db, get_admin_session(context).target_user_id)
+    if not target_user:
+        await message.reply_text("❌ User not found.")
+        end_admin_session(context)
+        return
+    
+    async def reply_insufficient(balance):
+        await message.reply_text(
+            f"❌ User has insufficient balance.\n"
+            f"Current balance: ${balance:.2f}\n"
+            f"Requested deduction: ${amount:.2f}"
+        )
+        end_admin_session(context)
+    
+    # Check sufficient balance
+    if target_user.balance < amount:
+        await reply_insufficient(target_user.balance)
+        return
+    
+    # Deduct balance
+    new_balance = await asyncio.to_thread(
+        deduct_user_balance, db, target_user, amount,
+        transaction_type='admin_deduct',
+        description=f"Admin deducted by {user.telegram_id}",
+        logged_by=user,
+        action=f"deduct_balance_{target_user.telegram_id}_{amount}"
+    )
+    
+    # The check above can be stale if a charge committed in between; the
+    # deduction itself is guarded, so trust its answer
+    if new_balance is None:
+        await asyncio.to_thread(db.refresh, target_user)
+        await reply_insufficient(target_user.balance)
+        return
+    
+    username_str = target_user.display_handle
+    await message.reply_text(BALANCE_DEDUCTED_TEMPLATE(amount, username_str, new_balance))
+    
+    end_admin_session(context)
+
+
+async def admin_set_price_for_range_input(message, context, db, user, text):
+    """Save the price sent by an admin for a range picked from the API list."""
+    price = parse_positive_amount(text)
+    if price is None:
+        await message.reply_text("❌ Invalid price. Please send a positive number (e.g., 2.5 or 10):")
+        return
+    
+    session = get_admin_session(context)
+    range_id = session.selected_range_id
+    range_name = session.selected_range_name or range_id
+    
+    # Check if price already exists
+    action = "updated" if get_set_price(db, range_id) is not None else "created"
+    await asyncio.to_thread(set_range_price, db, range_id, str(range_name), price, user)
+    
+    log_access(db, user, f"set_price_{range_id}_{price}")
+    
+    await message.reply_text(
+        f"✅ Price {action} successfully!\n"
+        f"Range: <code>{escape_html(str(range_name))}</code>\n"
+        f"Price: ${price:.2f}",
         parse_mode='HTML'
     )
     
-    try:
-        # Get scrapper session
-        scrapper = get_scrapper_session()
-        
-        # Search for SMS messages
-        data = scrapper.get_sms_messages(phone_number)
-        
-        if not data:
-            # Create keyboard with retry button
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                    InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "❌ Failed to retrieve SMS messages. Please try again.",
-                reply_markup=reply_markup
-            )
-            return
-        
-        # Parse response
-        total_records = data.get('iTotalRecords', '0')
-        if isinstance(total_records, str):
-            total_records = int(total_records) if total_records.isdigit() else 0
-        
-        messages = data.get('aaData', [])
-        
-        # Filter out the stats row
-        actual_messages = []
-        for msg in messages:
-            if isinstance(msg, list) and len(msg) >= 6:
-                if not is_stats_row(msg):
-                    actual_messages.append(msg)
-        
-        if not actual_messages:
-            # Create keyboard with retry button
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                    InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"📭 No SMS messages found for <code>{escape_html(phone_number)}</code>",
-                parse_mode='HTML',
-                reply_markup=reply_markup
-            )
-            return
-        
-        # SMS found! Mark as permanent and deduct balance
-        was_temporary = not held_number.is_permanent
-        price = 0.0
-        
-        if was_temporary:
-            # Get price for this range
-            price = get_price_for_range(db, held_number.range_id)
-            
-            # Deduct balance
-            new_balance = deduct_user_balance(
-                db, db_user, price, 
-                transaction_type='sms_charge',
-                description=f"SMS received on {phone_number}"
-            )
-            
-            if new_balance is None:
-                await query.edit_message_text(
-                    "❌ Insufficient balance to complete this transaction."
-                )
-                return
-            
-            # Mark as permanent hold
-            mark_number_permanent(db, db_user, phone_number)
-        
-        # Format messages
-        message_text = f"📱 <b>SMS Messages for {escape_html(phone_number)}</b>\n"
-        message_text += f"Found {len(actual_messages)} message(s)\n"
-        
-        # Show balance deduction info if it was just deducted
-        if was_temporary:
-            message_text += f"\n💸 Balance deducted: ${price:.2f}\n"
-            message_text += f"💰 New balance: ${db_user.balance:.2f}\n"
-        
-        message_text += "\n"
-        
-        for i, msg_data in enumerate(actual_messages, 1):
-            time = msg_data[0] if len(msg_data) > 0 else "N/A"
-            sender_id = msg_data[3] if len(msg_data) > 3 else "N/A"
-            sms_body = msg_data[5] if len(msg_data) > 5 else "N/A"
-            
-            # Clean up None values
-            if sender_id is None:
-                sender_id = "Unknown"
-            if sms_body is None:
-                sms_body = "(empty)"
-            
-            # Escape HTML in the content
-            time_escaped = escape_html(str(time))
-            sender_escaped = escape_html(str(sender_id))
-            body_escaped = escape_html(str(sms_body))
-            
-            message_text += f"<b>Message {i}:</b>\n"
-            message_text += f"🕒 <b>Time:</b> {time_escaped}\n"
-            message_text += f"📨 <b>Sender:</b> {sender_escaped}\n"
-            message_text += f"💬 <b>Message:</b>\n<pre>{body_escaped}</pre>\n\n"
-            
-            # Telegram has a message length limit
-            if len(message_text) > MAX_TELEGRAM_MESSAGE_LENGTH:
-                message_text += f"<i>... and {len(actual_messages) - i} more message(s)</i>"
-                break
-        
-        # Create keyboard with back button
-        keyboard = [[InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            message_text,
-            parse_mode='HTML',
-            reply_markup=reply_markup
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in SMS retry: {e}")
-        
-        # Create keyboard with retry button
-        keyboard = [
-            [
-                InlineKeyboardButton("🔄 Retry", callback_data=f"retry_sms_{phone_number}"),
-                InlineKeyboardButton("🏠 Main Menu", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "❌ An error occurred while searching for SMS messages. Please try again.",
-            reply_markup=reply_markup
-        )
+    end_admin_session(context)
+
+
+async def admin_set_range_price_input(message, context, db, user, text):
+    """Save the price sent by an admin for an uploaded range."""
+    price = parse_positive_amount(text)
+    if price is None:
+        await message.reply_text("❌ Invalid price. Please send a positive number (e.g., 1.50 or 5):")
+        return
+    
+    session = get_admin_session(context)
+    range_unique_id = session.range_unique_id
+    range_name = session.range_name or 'Unknown'
+    
+    # Set the price
+    await asyncio.to_thread(set_range_price, db, range_unique_id, range_name, price, user)
+    
+    log_access(db, user, f"set_range_price_{range_unique_id}_{price}")
+    
+    await message.reply_text(
+        f"✅ Price set successfully!\n"
+        f"Range: <b>{escape_html(range_name)}</b>\n"
+        f"New Price: ${price:.2f}",
+        parse_mode='HTML'
+    )
+    
+    end_admin_session(context)
+
+
+# Text input handlers for pending admin actions, keyed by AdminSession.action
+ADMIN_INPUT_HANDLERS = {
+    'add_balance_by_id_step1': partial(
+        admin_balance_target_input,
+        next_action='add_balance_by_id_step2',
+        heading="Add Balance to",
+        prompt="Please send the amount to add (e.g., 100 or 50.5):"
+    ),
+    'add_balance_by_id_step2': admin_add_balance_input,
+    'deduct_balance_by_id_step1': partial(
+        admin_balance_target_input,
+        next_action='deduct_balance_by_id_step2',
+        heading="Deduct Balance from",
+        prompt="Please send the amount to deduct (e.g., 10 or 5.5):"
+    ),
+    'deduct_balance_by_id_step2': admin_deduct_balance_input,
+    'add_balance': admin_add_balance_input,
+    'deduct_balance': admin_deduct_balance_input,
+    'set_price_for_specific_range': admin_set_price_for_range_input,
+    'set_range_price': admin_set_range_price_input,
+}
 
 
 async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2241,6 +2407,11 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not message or not message.text:
         return
     
+    # Dispatch on the pending admin action
+    handler = ADMIN_INPUT_HANDLERS.get(get_admin_session(context).action)
+    if not handler:
+        return
+    
     text = message.text.strip()
     db = get_db_session()
     
@@ -2256,365 +2427,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not is_user_admin(db, user.telegram_id):
             return
         
-        # Check if there's a pending admin action
-        admin_action = context.user_data.get('admin_action')
-        
-        if admin_action == 'add_balance_by_id_step1':
-            # Parse user ID
-            try:
-                target_telegram_id = int(text)
-                
-                # Find user
-                target_user = db.query(User).filter_by(telegram_id=target_telegram_id).first()
-                if not target_user:
-                    await message.reply_text(f"❌ User with ID {target_telegram_id} not found.")
-                    context.user_data.clear()
-                    return
-                
-                # Ask for amount
-                context.user_data['admin_action'] = 'add_balance_by_id_step2'
-                context.user_data['target_telegram_id'] = target_telegram_id
-                
-                username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
-                await message.reply_text(
-                    f"💰 <b>Add Balance to {username_str}</b>\n\n"
-                    f"Current balance: ${target_user.balance:.2f}\n\n"
-                    "Please send the amount to add (e.g., 100 or 50.5):",
-                    parse_mode='HTML'
-                )
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid user ID. Please send a valid number:")
-                return
-        
-        elif admin_action == 'add_balance_by_id_step2':
-            # Parse amount
-            try:
-                amount = float(text)
-                if amount <= 0:
-                    await message.reply_text("❌ Amount must be positive. Please try again:")
-                    return
-                
-                target_telegram_id = context.user_data.get('target_telegram_id')
-                target_user = db.query(User).filter_by(telegram_id=target_telegram_id).first()
-                
-                if not target_user:
-                    await message.reply_text("❌ User not found.")
-                    context.user_data.clear()
-                    return
-                
-                # Add balance
-                new_balance = add_user_balance(
-                    db, target_user, amount,
-                    transaction_type='admin_add',
-                    description=f"Admin added by {user.telegram_id}"
-                )
-                
-                log_access(db, user, f"add_balance_{target_telegram_id}_{amount}")
-                
-                username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
-                await message.reply_text(
-                    f"✅ Successfully added ${amount:.2f} to {username_str}\n"
-                    f"New balance: ${new_balance:.2f}"
-                )
-                
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid amount. Please send a valid number (e.g., 100 or 50.5):")
-                return
-        
-        elif admin_action == 'deduct_balance_by_id_step1':
-            # Parse user ID
-            try:
-                target_telegram_id = int(text)
-                
-                # Find user
-                target_user = db.query(User).filter_by(telegram_id=target_telegram_id).first()
-                if not target_user:
-                    await message.reply_text(f"❌ User with ID {target_telegram_id} not found.")
-                    context.user_data.clear()
-                    return
-                
-                # Ask for amount
-                context.user_data['admin_action'] = 'deduct_balance_by_id_step2'
-                context.user_data['target_telegram_id'] = target_telegram_id
-                
-                username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
-                await message.reply_text(
-                    f"💰 <b>Deduct Balance from {username_str}</b>\n\n"
-                    f"Current balance: ${target_user.balance:.2f}\n\n"
-                    "Please send the amount to deduct (e.g., 10 or 5.5):",
-                    parse_mode='HTML'
-                )
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid user ID. Please send a valid number:")
-                return
-        
-        elif admin_action == 'deduct_balance_by_id_step2':
-            # Parse amount
-            try:
-                amount = float(text)
-                if amount <= 0:
-                    await message.reply_text("❌ Amount must be positive. Please try again:")
-                    return
-                
-                target_telegram_id = context.user_data.get('target_telegram_id')
-                target_user = db.query(User).filter_by(telegram_id=target_telegram_id).first()
-                
-                if not target_user:
-                    await message.reply_text("❌ User not found.")
-                    context.user_data.clear()
-                    return
-                
-                # Check sufficient balance
-                if target_user.balance < amount:
-                    await message.reply_text(
-                        f"❌ User has insufficient balance.\n"
-                        f"Current balance: ${target_user.balance:.2f}\n"
-                        f"Requested deduction: ${amount:.2f}"
-                    )
-                    context.user_data.clear()
-                    return
-                
-                # Deduct balance
-                new_balance = deduct_user_balance(
-                    db, target_user, amount,
-                    transaction_type='admin_deduct',
-                    description=f"Admin deducted by {user.telegram_id}"
-                )
-                
-                log_access(db, user, f"deduct_balance_{target_telegram_id}_{amount}")
-                
-                username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
-                await message.reply_text(
-                    f"✅ Successfully deducted ${amount:.2f} from {username_str}\n"
-                    f"New balance: ${new_balance:.2f}"
-                )
-                
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid amount. Please send a valid number (e.g., 10 or 5.5):")
-                return
-        
-        elif admin_action == 'add_balance':
-            # Parse amount
-            try:
-                amount = float(text)
-                if amount <= 0:
-                    await message.reply_text("❌ Amount must be positive. Please try again:")
-                    return
-                
-                target_user_id = context.user_data.get('target_user_id')
-                target_user = db.query(User).filter_by(id=target_user_id).first()
-                
-                if not target_user:
-                    await message.reply_text("❌ User not found.")
-                    context.user_data.clear()
-                    return
-                
-                # Add balance
-                new_balance = add_user_balance(
-                    db, target_user, amount,
-                    transaction_type='admin_add',
-                    description=f"Admin added by {user.telegram_id}"
-                )
-                
-                log_access(db, user, f"add_balance_{target_user.telegram_id}_{amount}")
-                
-                username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
-                await message.reply_text(
-                    f"✅ Successfully added ${amount:.2f} to {username_str}\n"
-                    f"New balance: ${new_balance:.2f}"
-                )
-                
-                # Clear state
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid amount. Please send a valid number (e.g., 100 or 50.5):")
-                return
-        
-        elif admin_action == 'deduct_balance':
-            # Parse amount
-            try:
-                amount = float(text)
-                if amount <= 0:
-                    await message.reply_text("❌ Amount must be positive. Please try again:")
-                    return
-                
-                target_user_id = context.user_data.get('target_user_id')
-                target_user = db.query(User).filter_by(id=target_user_id).first()
-                
-                if not target_user:
-                    await message.reply_text("❌ User not found.")
-                    context.user_data.clear()
-                    return
-                
-                # Check sufficient balance
-                if target_user.balance < amount:
-                    await message.reply_text(
-                        f"❌ User has insufficient balance.\n"
-                        f"Current balance: ${target_user.balance:.2f}\n"
-                        f"Requested deduction: ${amount:.2f}"
-                    )
-                    context.user_data.clear()
-                    return
-                
-                # Deduct balance
-                new_balance = deduct_user_balance(
-                    db, target_user, amount,
-                    transaction_type='admin_deduct',
-                    description=f"Admin deducted by {user.telegram_id}"
-                )
-                
-                log_access(db, user, f"deduct_balance_{target_user.telegram_id}_{amount}")
-                
-                username_str = f"@{target_user.username}" if target_user.username else f"ID:{target_user.telegram_id}"
-                await message.reply_text(
-                    f"✅ Successfully deducted ${amount:.2f} from {username_str}\n"
-                    f"New balance: ${new_balance:.2f}"
-                )
-                
-                # Clear state
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid amount. Please send a valid number (e.g., 10 or 5.5):")
-                return
-        
-        elif admin_action == 'set_price_for_specific_range':
-            # Parse price for a specific range
-            try:
-                price = float(text)
-                if price <= 0:
-                    await message.reply_text("❌ Price must be positive. Please try again:")
-                    return
-                
-                range_id = context.user_data.get('selected_range_id')
-                range_name = context.user_data.get('selected_range_name', range_id)
-                
-                # Check if price already exists
-                existing = db.query(PriceRange).filter_by(range_pattern=range_id).first()
-                
-                if existing:
-                    # Update existing
-                    existing.price = price
-                    db.commit()
-                    action = "updated"
-                else:
-                    # Create new
-                    price_range = PriceRange(
-                        range_pattern=range_id,
-                        price=price,
-                        created_by=user.id
-                    )
-                    db.add(price_range)
-                    db.commit()
-                    action = "created"
-                
-                log_access(db, user, f"set_price_{range_id}_{price}")
-                
-                await message.reply_text(
-                    f"✅ Price {action} successfully!\n"
-                    f"Range: <code>{escape_html(str(range_name))}</code>\n"
-                    f"Price: ${price:.2f}",
-                    parse_mode='HTML'
-                )
-                
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid price. Please send a valid number (e.g., 2.5 or 10):")
-                return
-        
-        elif admin_action == 'set_price_pattern':
-            # Store pattern and ask for price
-            context.user_data['price_pattern'] = text.lower()
-            context.user_data['admin_action'] = 'set_price_amount'
-            
-            await message.reply_text(
-                f"💵 Pattern set: <code>{text.lower()}</code>\n\n"
-                "Now send the price (e.g., 2.5 or 10):",
-                parse_mode='HTML'
-            )
-            return
-        
-        elif admin_action == 'set_price_amount':
-            # Parse price
-            try:
-                price = float(text)
-                if price <= 0:
-                    await message.reply_text("❌ Price must be positive. Please try again:")
-                    return
-                
-                pattern = context.user_data.get('price_pattern')
-                
-                # Check if pattern already exists
-                existing = db.query(PriceRange).filter_by(range_pattern=pattern).first()
-                
-                if existing:
-                    # Update existing
-                    existing.price = price
-                    db.commit()
-                    action = "updated"
-                else:
-                    # Create new
-                    price_range = PriceRange(
-                        range_pattern=pattern,
-                        price=price,
-                        created_by=user.id
-                    )
-                    db.add(price_range)
-                    db.commit()
-                    action = "created"
-                
-                log_access(db, user, f"set_price_{pattern}_{price}")
-                
-                await message.reply_text(
-                    f"✅ Price range {action} successfully!\n"
-                    f"Pattern: <code>{pattern}</code>\n"
-                    f"Price: ${price:.2f}",
-                    parse_mode='HTML'
-                )
-                
-                # Clear state
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid price. Please send a valid number (e.g., 2.5 or 10):")
-                return
-        
-        elif admin_action == 'set_range_price':
-            # Handle price input for a specific range
-            try:
-                price = float(text)
-                if price <= 0:
-                    await message.reply_text("❌ Price must be positive. Please try again:")
-                    return
-                
-                range_unique_id = context.user_data.get('range_unique_id')
-                range_name = context.user_data.get('range_name', 'Unknown')
-                
-                # Set the price
-                set_range_price(db, range_unique_id, range_name, price, user)
-                
-                log_access(db, user, f"set_range_price_{range_unique_id}_{price}")
-                
-                await message.reply_text(
-                    f"✅ Price set successfully!\n"
-                    f"Range: <b>{escape_html(range_name)}</b>\n"
-                    f"New Price: ${price:.2f}",
-                    parse_mode='HTML'
-                )
-                
-                context.user_data.clear()
-                
-            except ValueError:
-                await message.reply_text("❌ Invalid price. Please send a valid number (e.g., 1.50 or 5):")
-                return
+        await handler(message, context, db, user, text)
     
     finally:
         db.close()
@@ -2641,7 +2454,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Check if waiting for CSV upload
-        admin_action = context.user_data.get('admin_action')
+        admin_action = get_admin_session(context).action
         if admin_action != 'upload_csv':
             return
         
@@ -2652,53 +2465,42 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await message.reply_text("❌ Please upload a CSV file (.csv extension)")
             return
         
-        # Download the file
+        # Download the file straight into memory, CSV uploads are small
         file = await context.bot.get_file(document.file_id)
-        import tempfile
-        import os
+        csv_buffer = io.BytesIO()
+        await file.download_to_memory(csv_buffer)
+        csv_buffer.seek(0)
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(mode='wb', suffix='.csv', delete=False) as temp_file:
-            temp_path = temp_file.name
-            await file.download_to_drive(temp_path)
+        # Send processing message
+        processing_msg = await message.reply_text("📤 Processing CSV file...")
         
-        try:
-            # Send processing message
-            processing_msg = await message.reply_text("📤 Processing CSV file...")
-            
-            # Import CSV data
-            success_count, error_count, errors = import_csv_data(db, temp_path)
-            
-            # Format result message
-            result_msg = f"✅ <b>CSV Import Complete</b>\n\n"
-            result_msg += f"✔️ Successfully imported: {success_count} numbers\n"
+        # Import CSV data in a worker thread, large files take a while
+        csvfile = io.TextIOWrapper(csv_buffer, encoding='utf-8', newline='')
+        success_count, error_count, errors = await asyncio.to_thread(import_csv_data, db, csvfile)
+        
+        # Format result message
+        result_msg = f"✅ <b>CSV Import Complete</b>\n\n"
+        result_msg += f"✔️ Successfully imported: {success_count} numbers\n"
+        
+        if error_count > 0:
+            result_msg += f"❌ Errors: {error_count}\n\n"
             
-            if error_count > 0:
-                result_msg += f"❌ Errors: {error_count}\n\n"
+            if errors:
+                result_msg += "<b>Error Details:</b>\n"
+                # Show first 10 errors
+                for error in errors[:10]:
+                    result_msg += f"• {error}\n"
                 
-                if errors:
-                    result_msg += "<b>Error Details:</b>\n"
-                    # Show first 10 errors
-                    for error in errors[:10]:
-                        result_msg += f"• {error}\n"
-                    
-                    if len(errors) > 10:
-                        result_msg += f"\n... and {len(errors) - 10} more errors"
-            
-            await processing_msg.edit_text(result_msg, parse_mode='HTML')
-            
-            # Clear admin action
-            context.user_data.clear()
-            
-            log_access(db, user, f"csv_upload_{success_count}_success_{error_count}_errors")
-            
-        finally:
-            # Clean up temporary file
-            try:
-                os.unlink(temp_path)
-            except OSError:
-                pass
-    
+                if len(errors) > 10:
+                    result_msg += f"\n... and {len(errors) - 10} more errors"
+        
+        await processing_msg.edit_text(result_msg, parse_mode='HTML')
+        
+        # Clear admin action
+        end_admin_session(context)
+        
+        log_access(db, user, f"csv_upload_{success_count}_success_{error_count}_errors")
+        
     finally:
         db.close()
 
@@ -2711,7 +2513,7 @@ async def admin_upload_csv_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_upload_csv")
     
-    context.user_data['admin_action'] = 'upload_csv'
+    start_admin_session(context, 'upload_csv')
     
     message = (
         "📤 <b>Upload CSV File</b>\n\n"
@@ -2740,8 +2542,8 @@ async def admin_manage_ranges_callback(query, context, db, db_user):
     
     log_access(db, db_user, "admin_manage_ranges")
     
-    # Get all ranges
-    all_ranges = get_all_ranges(db)
+    # Get all ranges together with their prices
+    all_ranges = get_all_ranges_with_prices(db)
     
     message = "📋 <b>Manage Ranges & Prices</b>\n\n"
     
@@ -2755,9 +2557,7 @@ async def admin_manage_ranges_callback(query, context, db, db_user):
     # Create keyboard with ranges
     keyboard = []
     
-    for range_obj, number_count in all_ranges[:15]:  # Show first 15
-        # Get current price
-        price = get_price_for_range(db, range_obj.unique_id)
+    for range_obj, number_count, price in all_ranges[:15]:  # Show first 15
         button_text = f"{range_obj.name} (${price:.2f}) - {number_count} nums"
         
         if len(button_text) > MAX_BUTTON_TEXT_LENGTH:
@@ -2791,9 +2591,9 @@ async def admin_set_range_price_callback(query, context, db, db_user, range_uniq
         await query.answer("❌ Range not found")
         return
     
-    context.user_data['admin_action'] = 'set_range_price'
-    context.user_data['range_unique_id'] = range_unique_id
-    context.user_data['range_name'] = range_obj.name
+    start_admin_session(
+        context, 'set_range_price', range_unique_id=range_unique_id, range_name=range_obj.name
+    )
     
     current_price = get_price_for_range(db, range_unique_id)
     
@@ -2825,6 +2625,8 @@ async def admin_delete_range_callback(query, context, db, db_user, range_unique_
     success = delete_range_and_numbers(db, range_unique_id)
     
     if success:
+        # The range's holds went with its numbers
+        clear_holds_caches(context.application)
         message = (
             f"✅ <b>Range Deleted</b>\n\n"
             f"Range '<b>{escape_html(range_obj.name)}</b>' and all its numbers have been deleted."
@@ -2838,38 +2640,68 @@ async def admin_delete_range_callback(query, context, db, db_user, range_unique_
     await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='HTML')
 
 
+def flush_queued_access_logs():
+    """Write queued access logs using a short-lived session."""
+    db = get_db_session()
+    try:
+        flush_access_logs(db)
+    except Exception as e:
+        logger.error(f"Failed to flush access logs: {e}")
+    finally:
+        db.close()
+
+
+async def access_log_flusher():
+    """Background task that periodically writes queued access logs."""
+    while True:
+        await asyncio.sleep(ACCESS_LOG_FLUSH_INTERVAL)
+        # The commit waits on disk, keep it off the event loop
+        await asyncio.to_thread(flush_queued_access_logs)
+
+
+async def post_init(application):
+    """Start background tasks once the application is initialized."""
+    application.bot_data['access_log_flusher'] = asyncio.create_task(access_log_flusher())
+
+
+async def post_shutdown(application):
+    """Stop background tasks and write any access logs still queued."""
+    flusher = application.bot_data.pop('access_log_flusher', None)
+    if flusher:
+        flusher.cancel()
+    await asyncio.to_thread(flush_queued_access_logs)
+
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors in a clean and informative way."""
     # Extract useful information from update
-    update_info = "No update information"
+    info_parts = []
     if update:
         try:
             if update.effective_user:
                 user_id = update.effective_user.id
                 username = update.effective_user.username or "N/A"
-                update_info = f"User {user_id} (@{username})"
+                info_parts.append(f"User {user_id} (@{username})")
             
             if update.effective_chat:
-                chat_id = update.effective_chat.id
-                update_info += f", Chat {chat_id}"
+                info_parts.append(f"Chat {update.effective_chat.id}")
             
             if update.message and update.message.text:
                 text = update.message.text[:100]  # Truncate long messages
-                update_info += f", Text: '{text}'"
+                info_parts.append(f"Text: '{text}'")
             elif update.callback_query:
-                data = update.callback_query.data
-                update_info += f", Callback: '{data}'"
+                info_parts.append(f"Callback: '{update.callback_query.data}'")
         except Exception as e:
-            update_info += f" (Error extracting info: {e})"
+            info_parts.append(f"(Error extracting info: {e})")
+    update_info = ", ".join(info_parts) or "No update information"
     
     # Log the error with clean information
     error_msg = f"Error occurred: {context.error.__class__.__name__}: {str(context.error)}"
     logger.error(f"{update_info} - {error_msg}")
     
-    # Log full traceback at debug level
-    if context.error:
-        tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-        tb_string = ''.join(tb_list)
+    # Log full traceback at debug level, formatting it only if it will be shown
+    if context.error and logger.isEnabledFor(logging.DEBUG):
+        tb_string = ''.join(traceback.format_exception(None, context.error, context.error.__traceback__))
         logger.debug(f"Full traceback:\n{tb_string}")
 
 
@@ -2895,13 +2727,17 @@ async def auto_fetch_sms_job(context: ContextTypes.DEFAULT_TYPE):
 
     db = get_db_session()
     try:
-        # Clean up expired holds (6 hours by default)
-        cleaned = cleanup_expired_holds(db, expiry_hours=HOLD_EXPIRY_HOURS)
+        # Clean up expired holds (6 hours by default); the job's database
+        # work runs in a worker thread like its HTTP request
+        cleaned = await asyncio.to_thread(cleanup_expired_holds, db, expiry_hours=HOLD_EXPIRY_HOURS)
         if cleaned > 0:
             logger.info(f"Auto-cleanup: Released {cleaned} expired holds")
+            clear_holds_caches(context.application)
 
-        # Get all active (non-permanent) holds
-        active_holds = get_all_active_holds(db)
+        # Get all active (non-permanent) holds with their holders' Telegram
+        # IDs, as plain rows: charging commits, and reading expired ORM
+        # objects afterwards would reload them one by one on the event loop
+        active_holds = await asyncio.to_thread(get_all_active_holds, db)
         if not active_holds:
             return
 
@@ -2915,9 +2751,10 @@ async def auto_fetch_sms_job(context: ContextTypes.DEFAULT_TYPE):
         if not holds_by_number:
             return
 
-        # Fetch all recent SMS from server
+        # Fetch all recent SMS from server; this is the slowest request the
+        # bot makes, so keep it off the event loop
         scrapper = get_scrapper_session()
-        data = scrapper.get_all_recent_sms()
+        data = await asyncio.to_thread(scrapper.get_all_recent_sms)
 
         if not data:
             return
@@ -2949,11 +2786,6 @@ async def auto_fetch_sms_job(context: ContextTypes.DEFAULT_TYPE):
 
             # Found a match! Process it
             try:
-                # Get the user who holds this number
-                user = db.query(User).get(hold.user_id)
-                if not user:
-                    continue
-
                 # Use the rate from the API response (column index 7)
                 try:
                     price = float(msg[7]) if len(msg) > 7 and msg[7] is not None else 0.0
@@ -2962,18 +2794,16 @@ async def auto_fetch_sms_job(context: ContextTypes.DEFAULT_TYPE):
                 if price < 0:
                     price = 0.0
 
-                # Deduct balance
-                new_balance = deduct_user_balance(
-                    db, user, price,
-                    transaction_type='sms_charge',
+                # Deduct balance; the hold is only made permanent if that succeeds
+                new_balance = await asyncio.to_thread(
+                    charge_for_sms, db, hold.user_id, hold.phone_number_str, price,
                     description=f"SMS received on {hold.phone_number_str}"
                 )
 
-                if new_balance is not None:
-                    # Mark as permanent hold only after successful balance deduction
-                    mark_number_permanent(db, user, hold.phone_number_str)
-                else:
-                    logger.warning(f"Auto-SMS: Insufficient balance for user {user.telegram_id}")
+                if new_balance is SMS_ALREADY_CHARGED:
+                    logger.info(f"Auto-SMS: {hold.phone_number_str} was already charged")
+                elif new_balance is None:
+                    logger.warning(f"Auto-SMS: Insufficient balance for user {hold.telegram_id}")
 
                 # Remove from lookup so we don't process again in this batch
                 del holds_by_number[sms_number_clean]
@@ -2999,7 +2829,7 @@ async def auto_fetch_sms_job(context: ContextTypes.DEFAULT_TYPE):
                         text=group_message,
                         parse_mode='HTML'
                     )
-                    logger.info(f"Auto-SMS: Posted SMS for {hold.phone_number_str} (user {user.telegram_id})")
+                    logger.info(f"Auto-SMS: Posted SMS for {hold.phone_number_str} (user {hold.telegram_id})")
                 except Exception as e:
                     logger.error(f"Auto-SMS: Failed to post to group: {e}")
 
@@ -3015,7 +2845,20 @@ async def auto_fetch_sms_job(context: ContextTypes.DEFAULT_TYPE):
 def main():
     """Start the bot."""
     # Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Stay within Telegram's flood limits instead of hitting RetryAfter
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Register command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -1,19 +1,59 @@
 """Database models and initialization for the Telegram bot."""
 
 import os
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Float, Text
+import logging
+from collections import Counter, deque
+from time import monotonic
+from datetime import datetime, time, timedelta
+from sqlalchemy import create_engine, event, insert, select, update, exists, tuple_, func, case, and_, lambda_stmt, Column, BigInteger, Integer, String, Boolean, DateTime, ForeignKey, Float, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
+# Development aid: flag ORM statements repeated within one session (N+1)
+# Set to "true" to log a warning or "raise" to fail loudly
+DEBUG_N_PLUS_ONE = os.getenv("DEBUG_N_PLUS_ONE", "false").lower()
+N_PLUS_ONE_THRESHOLD = 5
 
-def get_admin_telegram_ids():
-    """Get list of admin Telegram IDs from environment."""
+# Price charged for ranges without an explicit price
+DEFAULT_RANGE_PRICE = 1.0
+
+# All range prices are cached together for this long; the table is small
+# and changes rarely, so one query refreshes every range at once
+PRICE_CACHE_TTL = 300  # seconds
+_price_cache = {'prices': None, 'expires_at': 0.0}
+
+# Admin flags are cached across updates: telegram_id -> (is_admin, expires_at)
+ADMIN_STATUS_CACHE_TTL = 60  # seconds
+ADMIN_STATUS_CACHE_MAXSIZE = 10000
+_admin_status_cache = {}
+
+# Engines are shared per database file so their connection pools are reused
+_engines = {}
+
+# Access logs are queued in memory and written in batches instead of
+# committing once per user action
+_access_log_queue = deque()
+
+# Returned by charge_for_sms when someone else already charged the hold
+SMS_ALREADY_CHARGED = object()
+
+# Expired holds are deleted in batches of this many rows
+HOLD_CLEANUP_BATCH_SIZE = 1000
+
+# CSV imports look numbers up and insert them in chunks
+CSV_LOOKUP_CHUNK_SIZE = 500  # Stays under SQLite's bound parameter limit
+CSV_INSERT_BATCH_SIZE = 10000
+
+
+def _parse_admin_telegram_ids():
+    """Parse the list of admin Telegram IDs from environment."""
     admin_ids_str = os.getenv("ADMIN_TELEGRAM_IDS", "")
     if not admin_ids_str:
         return []
@@ -29,12 +69,21 @@ def get_admin_telegram_ids():
     return admin_ids
 
 
+# Parsed once at import; ADMIN_TELEGRAM_IDS doesn't change while running
+ADMIN_IDS = frozenset(_parse_admin_telegram_ids())
+
+
+def get_admin_telegram_ids():
+    """Get the admin Telegram IDs from environment, as parsed at startup."""
+    return ADMIN_IDS
+
+
 class User(Base):
     """User model for storing Telegram user information."""
     __tablename__ = 'users'
     
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False, index=True)
+    telegram_id = Column(BigInteger, unique=True, nullable=False, index=True)
     username = Column(String(255), nullable=True)
     is_admin = Column(Boolean, default=False, nullable=False)
     is_banned = Column(Boolean, default=False, nullable=False)
@@ -44,10 +93,18 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     
     # Relationships
-    access_logs = relationship('AccessLog', back_populates='user', cascade='all, delete-orphan')
-    number_holds = relationship('NumberHold', back_populates='user', cascade='all, delete-orphan')
-    transactions = relationship('Transaction', back_populates='user', cascade='all, delete-orphan')
-    recharge_requests = relationship('RechargeRequest', back_populates='user', cascade='all, delete-orphan')
+    # Nothing relies on implicit lazy loads, so they raise instead of quietly
+    # adding a query per object; use selectinload() where children are needed.
+    # Logs grow without bound, so they can't be loaded even from the identity map
+    access_logs = relationship('AccessLog', back_populates='user', cascade='all, delete-orphan', lazy='raise')
+    number_holds = relationship('NumberHold', back_populates='user', cascade='all, delete-orphan', lazy='raise_on_sql')
+    transactions = relationship('Transaction', back_populates='user', cascade='all, delete-orphan', lazy='raise_on_sql')
+    recharge_requests = relationship('RechargeRequest', back_populates='user', cascade='all, delete-orphan', lazy='raise_on_sql')
+    
+    @property
+    def display_handle(self):
+        """@username if the user has one, otherwise their Telegram ID."""
+        return f"@{self.username}" if self.username else f"ID:{self.telegram_id}"
     
     def __repr__(self):
         return f"<User(telegram_id={self.telegram_id}, username={self.username}, is_admin={self.is_admin}, is_banned={self.is_banned}, balance={self.balance})>"
@@ -63,7 +120,7 @@ class AccessLog(Base):
     action = Column(String(255), nullable=False)
     
     # Relationship to user
-    user = relationship('User', back_populates='access_logs')
+    user = relationship('User', back_populates='access_logs', lazy='raise_on_sql')
     
     def __repr__(self):
         return f"<AccessLog(user_id={self.user_id}, action={self.action}, timestamp={self.timestamp})>"
@@ -80,7 +137,7 @@ class Range(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     
     # Relationships
-    phone_numbers = relationship('PhoneNumber', back_populates='range', cascade='all, delete-orphan')
+    phone_numbers = relationship('PhoneNumber', back_populates='range', cascade='all, delete-orphan', lazy='raise_on_sql')
     
     def __repr__(self):
         return f"<Range(unique_id={self.unique_id}, name={self.name})>"
@@ -96,8 +153,8 @@ class PhoneNumber(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     
     # Relationships
-    range = relationship('Range', back_populates='phone_numbers')
-    number_holds = relationship('NumberHold', back_populates='phone_number', cascade='all, delete-orphan')
+    range = relationship('Range', back_populates='phone_numbers', lazy='raise_on_sql')
+    number_holds = relationship('NumberHold', back_populates='phone_number', cascade='all, delete-orphan', lazy='raise_on_sql')
     
     def __repr__(self):
         return f"<PhoneNumber(number={self.number}, range_id={self.range_id})>"
@@ -108,7 +165,7 @@ class NumberHold(Base):
     __tablename__ = 'number_holds'
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # Indexed by the composites below
     phone_number_id = Column(Integer, ForeignKey('phone_numbers.id'), nullable=True, index=True)  # NULL for legacy holds
     phone_number_str = Column(String(50), nullable=False, index=True)  # Keep for backward compatibility
     range_id = Column(String(50), nullable=False)  # Range unique_id
@@ -117,8 +174,18 @@ class NumberHold(Base):
     is_permanent = Column(Boolean, default=False, nullable=False)
     
     # Relationships
-    user = relationship('User', back_populates='number_holds')
-    phone_number = relationship('PhoneNumber', back_populates='number_holds')
+    user = relationship('User', back_populates='number_holds', lazy='raise_on_sql')
+    phone_number = relationship('PhoneNumber', back_populates='number_holds', lazy='raise_on_sql')
+    
+    # Hold lookups filter a user's (temporary) holds, optionally for one
+    # number; the cleanup sweep and hold summary filter temporary holds by
+    # start and first retry time
+    __table_args__ = (
+        Index('ix_holds_user_perm', 'user_id', 'is_permanent'),
+        Index('ix_holds_user_num_perm', 'user_id', 'phone_number_str', 'is_permanent'),
+        Index('ix_holds_perm_start', 'is_permanent', 'hold_start_time'),
+        Index('ix_holds_perm_retry', 'is_permanent', 'first_retry_time'),
+    )
     
     def __repr__(self):
         return f"<NumberHold(user_id={self.user_id}, phone_number={self.phone_number_str}, is_permanent={self.is_permanent})>"
@@ -151,7 +218,7 @@ class Transaction(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     
     # Relationship to user
-    user = relationship('User', back_populates='transactions')
+    user = relationship('User', back_populates='transactions', lazy='raise_on_sql')
     
     def __repr__(self):
         return f"<Transaction(user_id={self.user_id}, amount={self.amount}, type={self.transaction_type})>"
@@ -171,7 +238,7 @@ class RechargeRequest(Base):
     processed_by = Column(Integer, nullable=True)  # Store admin user ID directly, no FK
     
     # Relationships
-    user = relationship('User', back_populates='recharge_requests')
+    user = relationship('User', back_populates='recharge_requests', lazy='raise_on_sql')
     
     def __repr__(self):
         return f"<RechargeRequest(user_id={self.user_id}, amount={self.amount}, status={self.status})>"
@@ -236,6 +303,22 @@ def migrate_database(engine):
                         FROM number_holds_old
                     """)
                     cursor.execute("DROP TABLE number_holds_old")
+            
+            # create_all() only indexes new tables, so add these to existing ones
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS ix_holds_user_perm ON number_holds (user_id, is_permanent)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS ix_holds_user_num_perm ON number_holds (user_id, phone_number_str, is_permanent)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS ix_holds_perm_start ON number_holds (is_permanent, hold_start_time)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS ix_holds_perm_retry ON number_holds (is_permanent, first_retry_time)"
+            )
+            # user_id leads the composite indexes, so its own index is redundant
+            cursor.execute("DROP INDEX IF EXISTS ix_number_holds_user_id")
         
         # Check and update price_ranges table if it exists
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='price_ranges'")
@@ -266,10 +349,71 @@ def migrate_database(engine):
         pass
 
 
+class NPlusOneError(RuntimeError):
+    """Raised when the same query runs repeatedly in one session."""
+
+
+def enable_n_plus_one_detection(session_factory, raise_error=False):
+    """Report ORM statements executed N_PLUS_ONE_THRESHOLD times in one session."""
+    def check_repeated_statement(orm_execute_state):
+        counts = orm_execute_state.session.info.setdefault('statement_counts', Counter())
+        sql = str(orm_execute_state.statement)
+        counts[sql] += 1
+        if counts[sql] == N_PLUS_ONE_THRESHOLD:
+            message = f"Possible N+1 query, executed {N_PLUS_ONE_THRESHOLD} times in one session: {sql}"
+            if raise_error:
+                raise NPlusOneError(message)
+            logger.warning(message)
+    
+    event.listen(session_factory, 'do_orm_execute', check_repeated_statement)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Configure every new SQLite connection for concurrent access."""
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers proceed during writes, and NORMAL sync is safe in WAL
+    # mode while avoiding an fsync on every commit
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Wait for a competing writer instead of failing with "database is locked"
+    cursor.execute("PRAGMA busy_timeout=5000")
+    # Keep temp tables/indexes in memory and read the file through mmap
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    # Each pooled connection keeps a ~4 MB page cache warm between sessions;
+    # reads mostly go through the shared mmap, and with up to 50 pooled
+    # connections this caps private caches at ~200 MB
+    cursor.execute("PRAGMA cache_size=-4000")
+    cursor.close()
+
+
+def get_engine(db_path='bot.db'):
+    """Return the shared engine for a database file, creating it on first use."""
+    engine = _engines.get(db_path)
+    if engine is None:
+        db_url = f'sqlite:///{db_path}'
+        # Keep a sized pool of connections so concurrent updates don't queue up
+        # behind the default five; connections may be used from worker threads
+        engine = create_engine(
+            db_url,
+            echo=False,
+            pool_size=25,
+            max_overflow=25,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            # Room for every statement shape (ORM queries, lazy loads, the
+            # lambda_stmt lookups) so none falls out of the compiled cache
+            query_cache_size=1200,
+            connect_args={'check_same_thread': False}
+        )
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        _engines[db_path] = engine
+    return engine
+
+
 def init_db(db_path='bot.db'):
     """Initialize the database and create tables. Returns a session factory."""
-    db_url = f'sqlite:///{db_path}'
-    engine = create_engine(db_url, echo=False)
+    engine = get_engine(db_path)
     
     # Migrate existing database
     migrate_database(engine)
@@ -277,42 +421,119 @@ def init_db(db_path='bot.db'):
     # Create new tables
     Base.metadata.create_all(engine)
     SessionFactory = sessionmaker(bind=engine)
+    if DEBUG_N_PLUS_ONE in ('true', 'raise'):
+        enable_n_plus_one_detection(SessionFactory, raise_error=DEBUG_N_PLUS_ONE == 'raise')
     return SessionFactory
 
 
+def get_user_by_id(db_session, user_id):
+    """Get a user by primary key, or None if not found."""
+    # Session.get returns an already loaded user from the identity map
+    # without a round trip
+    return db_session.get(User, user_id)
+
+
+def get_user_by_telegram_id(db_session, telegram_id):
+    """Get a user by Telegram ID, or None if not found."""
+    stmt = lambda_stmt(lambda: select(User).where(User.telegram_id == telegram_id))
+    return db_session.execute(stmt).scalar_one_or_none()
+
+
+def get_users_page(db_session, cursor, limit):
+    """Get up to limit users newest first, after the (created_at, id) cursor if given."""
+    # Keyset pagination: continue after the (created_at, id) of the last
+    # user on the previous page instead of skipping rows with OFFSET
+    users_query = db_session.query(User)
+    if cursor:
+        users_query = users_query.filter(tuple_(User.created_at, User.id) < cursor)
+    return users_query.order_by(User.created_at.desc(), User.id.desc()).limit(limit).all()
+
+
 def get_or_create_user(db_session, telegram_id, username=None):
     """Get existing user or create a new one."""
-    user = db_session.query(User).filter_by(telegram_id=telegram_id).first()
+    user = get_user_by_telegram_id(db_session, telegram_id)
     if not user:
         user = User(telegram_id=telegram_id, username=username)
         db_session.add(user)
         db_session.commit()
+    
+    # The row is loaded anyway, so later is_user_admin checks in this
+    # session need no query of their own
+    cache_admin_flag(db_session, telegram_id, user.is_admin)
     return user
 
 
 def log_access(db_session, user, action):
-    """Log user access action."""
-    log = AccessLog(user_id=user.id, action=action)
-    db_session.add(log)
+    """Queue a user access action to be written by flush_access_logs."""
+    _access_log_queue.append({
+        'user_id': user.id,
+        'action': action,
+        'timestamp': datetime.utcnow(),
+    })
+
+
+def flush_access_logs(db_session):
+    """Write all queued access logs in one transaction. Returns the count written."""
+    batch = []
+    try:
+        while True:
+            batch.append(_access_log_queue.popleft())
+    except IndexError:
+        pass
+    
+    if not batch:
+        return 0
+    
+    # Core executemany; no ORM bookkeeping for rows nobody reads back
+    db_session.execute(insert(AccessLog), batch)
     db_session.commit()
+    return len(batch)
+
+
+def cache_admin_flag(db_session, telegram_id, is_admin):
+    """Remember a user's database admin flag for this session and a short while after."""
+    db_session.info.setdefault('admin_flags', {})[telegram_id] = bool(is_admin)
+    now = monotonic()
+    if len(_admin_status_cache) >= ADMIN_STATUS_CACHE_MAXSIZE:
+        # Every user who messages the bot lands here, so keep the cache
+        # bounded: drop expired entries, or start over if all are fresh
+        expired = [key for key, (_, expires_at) in _admin_status_cache.items() if expires_at <= now]
+        for key in expired:
+            del _admin_status_cache[key]
+        if len(_admin_status_cache) >= ADMIN_STATUS_CACHE_MAXSIZE:
+            _admin_status_cache.clear()
+    _admin_status_cache[telegram_id] = (bool(is_admin), now + ADMIN_STATUS_CACHE_TTL)
 
 
 def is_user_admin(db_session, telegram_id):
     """Check if user is an admin (checks both environment and database)."""
     # Check if user is in ADMIN_TELEGRAM_IDS from environment
-    admin_ids = get_admin_telegram_ids()
-    if telegram_id in admin_ids:
+    if telegram_id in ADMIN_IDS:
         return True
     
-    # Also check database for dynamically granted admin status
-    user = db_session.query(User).filter_by(telegram_id=telegram_id).first()
-    return user and user.is_admin
+    # Sessions live for a single update, so a flag seen earlier in this
+    # session is still current
+    admin_flags = db_session.info.get('admin_flags', {})
+    if telegram_id in admin_flags:
+        return admin_flags[telegram_id]
+    
+    # Admin status rarely changes, so reuse a recent answer from another update
+    cached = _admin_status_cache.get(telegram_id)
+    if cached and cached[1] > monotonic():
+        return cached[0]
+    
+    # Also check database for dynamically granted admin status; only the
+    # flag is needed, not the whole user
+    stmt = lambda_stmt(lambda: select(User.is_admin).where(User.telegram_id == telegram_id))
+    is_admin = bool(db_session.execute(stmt).scalar())
+    cache_admin_flag(db_session, telegram_id, is_admin)
+    return is_admin
 
 
 def is_user_banned(db_session, telegram_id):
     """Check if user is banned."""
-    user = db_session.query(User).filter_by(telegram_id=telegram_id).first()
-    return user and user.is_banned
+    stmt = lambda_stmt(lambda: select(User.is_banned).where(User.telegram_id == telegram_id))
+    return bool(db_session.execute(stmt).scalar())
 
 
 def get_user_balance(db_session, user):
@@ -320,92 +541,196 @@ def get_user_balance(db_session, user):
     return user.balance
 
 
-def add_user_balance(db_session, user, amount, transaction_type='admin_add', description=None):
-    """Add balance to user account."""
-    user.balance += amount
-    transaction = Transaction(
+def _add_balance_access_log(db_session, user, logged_by, action):
+    """Record a balance change in the access log, in the caller's transaction."""
+    if action:
+        actor = logged_by or user
+        db_session.execute(insert(AccessLog).values(user_id=actor.id, action=action))
+
+
+def add_user_balance(db_session, user, amount, transaction_type='admin_add', description=None,
+                     logged_by=None, action=None):
+    """Add balance to user account. An access log action, if given, is committed with it."""
+    # Let the database do the arithmetic so concurrent writers don't overwrite each other
+    db_session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(balance=User.balance + amount)
+    )
+    db_session.execute(insert(Transaction).values(
         user_id=user.id,
         amount=amount,
         transaction_type=transaction_type,
         description=description
-    )
-    db_session.add(transaction)
+    ))
+    _add_balance_access_log(db_session, user, logged_by, action)
     db_session.commit()
     return user.balance
 
 
-def deduct_user_balance(db_session, user, amount, transaction_type='sms_charge', description=None):
-    """Deduct balance from user account."""
-    if user.balance < amount:
-        return None  # Insufficient balance
-    user.balance -= amount
-    user.total_spent += amount
-    transaction = Transaction(
-        user_id=user.id,
+def _deduct_balance(db_session, user_id, amount, transaction_type, description):
+    """Deduct a balance and record the transaction, uncommitted. Returns False if it was too low."""
+    # The balance check and the deduction are one statement, so two charges can't both pass it
+    result = db_session.execute(
+        update(User)
+        .where(User.id == user_id, User.balance >= amount)
+        .values(balance=User.balance - amount, total_spent=User.total_spent + amount)
+    )
+    if result.rowcount == 0:
+        return False
+    db_session.execute(insert(Transaction).values(
+        user_id=user_id,
         amount=-amount,
         transaction_type=transaction_type,
         description=description
-    )
-    db_session.add(transaction)
-    db_session.commit()
+    ))
+    return True
+
+
+def deduct_user_balance(db_session, user, amount, transaction_type='sms_charge', description=None,
+                        logged_by=None, action=None, commit=True):
+    """Deduct balance from user account. An access log action, if given, is committed with it.
+
+    Pass commit=False to leave the charge pending so a follow-up write shares its commit.
+    """
+    if not _deduct_balance(db_session, user.id, amount, transaction_type, description):
+        return None  # Insufficient balance
+    _add_balance_access_log(db_session, user, logged_by, action)
+    if commit:
+        db_session.commit()
     return user.balance
 
 
 def get_price_for_range(db_session, range_unique_id):
     """Get price for a specific range by unique ID."""
-    price_range = db_session.query(PriceRange).filter_by(range_unique_id=str(range_unique_id)).first()
-    
-    if price_range:
-        return price_range.price
+    prices = _price_cache['prices']
+    if prices is None or _price_cache['expires_at'] <= monotonic():
+        # Plain (range_unique_id, price) tuples, no ORM objects
+        prices = dict(db_session.execute(
+            select(PriceRange.range_unique_id, PriceRange.price)
+        ).all())
+        _price_cache['prices'] = prices
+        _price_cache['expires_at'] = monotonic() + PRICE_CACHE_TTL
     
     # Default price if no price set for this range
-    return 1.0
+    return prices.get(str(range_unique_id), DEFAULT_RANGE_PRICE)
+
+
+def get_set_price(db_session, range_unique_id):
+    """Get the price set for a range, or None if it has no price yet."""
+    return db_session.execute(
+        select(PriceRange.price).where(PriceRange.range_unique_id == range_unique_id)
+    ).scalar()
+
+
+def get_latest_price_ranges(db_session, limit=10):
+    """Get the names and prices of the most recently created price ranges."""
+    return db_session.execute(
+        select(PriceRange.range_name, PriceRange.price)
+        .order_by(PriceRange.created_at.desc())
+        .limit(limit)
+    ).all()
+
+
+def invalidate_price_cache():
+    """Forget cached prices after a price changes."""
+    # The snapshot covers every range, so any change reloads it whole
+    _price_cache['prices'] = None
 
 
 def create_number_holds(db_session, user, phone_number_ids, range_unique_id):
-    """Create temporary holds for phone numbers."""
-    from datetime import datetime
-    
+    """Create temporary holds for phone numbers. Returns the number of holds created."""
     # Release all non-permanent holds for this user
     db_session.query(NumberHold).filter_by(
         user_id=user.id,
-    ).filter(NumberHold.is_permanent.is_(False)).delete()
-    
-    # Create new holds
-    holds = []
-    for phone_number_id in phone_number_ids:
-        # Get the phone number object
-        phone_number = db_session.query(PhoneNumber).get(phone_number_id)
-        if phone_number:
-            hold = NumberHold(
-                user_id=user.id,
-                phone_number_id=phone_number.id,
-                phone_number_str=phone_number.number,
-                range_id=str(range_unique_id),
-                hold_start_time=datetime.utcnow()
-            )
-            holds.append(hold)
-            db_session.add(hold)
+    ).filter(NumberHold.is_permanent.is_(False)).delete(synchronize_session=False)
     
+    # Look up all the numbers at once, then insert the holds in one executemany
+    # without building ORM objects
+    numbers = db_session.query(PhoneNumber.id, PhoneNumber.number).filter(
+        PhoneNumber.id.in_(phone_number_ids)
+    ).all() if phone_number_ids else []
+    
+    now = datetime.utcnow()
+    range_id = str(range_unique_id)
+    if numbers:
+        db_session.execute(insert(NumberHold), [
+            {
+                'user_id': user.id,
+                'phone_number_id': phone_number_id,
+                'phone_number_str': number,
+                'range_id': range_id,
+                'hold_start_time': now,
+                'is_permanent': False,
+            }
+            for phone_number_id, number in numbers
+        ])
+    
+    # Release and create in a single commit
     db_session.commit()
-    return holds
+    return len(numbers)
 
 
-def mark_number_permanent(db_session, user, phone_number_str):
+def mark_number_permanent(db_session, user, phone_number_str, commit=True):
     """Mark a number hold as permanent when SMS is received."""
-    hold = db_session.query(NumberHold).filter_by(
-        user_id=user.id,
-        phone_number_str=str(phone_number_str)
-    ).filter(NumberHold.is_permanent.is_(False)).first()
+    user_id = user.id
+    phone_number_str = str(phone_number_str)
+    stmt = lambda_stmt(lambda: select(NumberHold).where(
+        NumberHold.user_id == user_id,
+        NumberHold.phone_number_str == phone_number_str,
+        NumberHold.is_permanent.is_(False)
+    ).limit(1))
+    hold = db_session.execute(stmt).scalar_one_or_none()
     
     if hold:
         hold.is_permanent = True
         user.total_sms_received += 1
-        db_session.commit()
+        if commit:
+            db_session.commit()
         return True
     return False
 
 
+def charge_for_sms(db_session, user_id, phone_number_str, price, description=None):
+    """
+    Charge a user for an SMS and make their hold on the number permanent.
+
+    Takes the user's ID rather than a User, so callers holding plain values
+    don't need loaded ORM objects. Both writes share one commit. Returns the
+    new balance, None if the balance was insufficient, or SMS_ALREADY_CHARGED
+    if the hold was no longer temporary. Nothing is written in the last two
+    cases.
+    """
+    # Flipping the hold is the guard: only the caller that turns it
+    # permanent gets to charge, even if another one got here first
+    result = db_session.execute(
+        update(NumberHold)
+        .where(
+            NumberHold.user_id == user_id,
+            NumberHold.phone_number_str == str(phone_number_str),
+            NumberHold.is_permanent.is_(False)
+        )
+        .values(is_permanent=True),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount == 0:
+        db_session.rollback()
+        return SMS_ALREADY_CHARGED
+    
+    if not _deduct_balance(db_session, user_id, price, 'sms_charge', description):
+        db_session.rollback()
+        return None
+    
+    db_session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(total_sms_received=User.total_sms_received + 1)
+    )
+    new_balance = db_session.execute(select(User.balance).where(User.id == user_id)).scalar()
+    db_session.commit()
+    return new_balance
+
+
 def get_held_numbers(db_session, user_id=None):
     """Get all held numbers, optionally filtered by user."""
     query = db_session.query(NumberHold)
@@ -416,8 +741,12 @@ def get_held_numbers(db_session, user_id=None):
 
 def is_number_held(db_session, phone_number_str):
     """Check if a phone number is currently held by any user."""
-    hold = db_session.query(NumberHold).filter_by(phone_number_str=str(phone_number_str)).first()
-    return hold is not None
+    # EXISTS returns a single flag instead of loading a NumberHold
+    phone_number_str = str(phone_number_str)
+    stmt = lambda_stmt(
+        lambda: select(exists().where(NumberHold.phone_number_str == phone_number_str))
+    )
+    return db_session.execute(stmt).scalar()
 
 
 def cleanup_expired_holds(db_session, expiry_hours=6):
@@ -428,42 +757,154 @@ def cleanup_expired_holds(db_session, expiry_hours=6):
       from when they were created (hold_start_time).
     - Permanent holds (successful SMS) are never released.
     """
-    from datetime import datetime, timedelta
-    
     now = datetime.utcnow()
     expiry_time = now - timedelta(hours=expiry_hours)
     
-    # Delete non-permanent holds that are older than expiry_hours
-    expired_holds = db_session.query(NumberHold).filter(
+    # Delete non-permanent holds that are older than expiry_hours, a batch
+    # per transaction so a large backlog never holds the write lock for long
+    expired_ids = select(NumberHold.id).where(
         NumberHold.is_permanent.is_(False),
         NumberHold.hold_start_time < expiry_time
-    )
+    ).limit(HOLD_CLEANUP_BATCH_SIZE).scalar_subquery()
     
-    count = expired_holds.delete()
-    db_session.commit()
-    
-    return count
+    count = 0
+    while True:
+        # Nothing uses the deleted holds afterwards, so skip matching them
+        # against the session
+        deleted = db_session.query(NumberHold).filter(
+            NumberHold.id.in_(expired_ids)
+        ).delete(synchronize_session=False)
+        db_session.commit()
+        count += deleted
+        if deleted < HOLD_CLEANUP_BATCH_SIZE:
+            return count
 
 
 def get_all_active_holds(db_session):
-    """Get all non-permanent (active) holds with their associated users."""
-    return db_session.query(NumberHold).filter(
-        NumberHold.is_permanent.is_(False)
+    """
+    Get all non-permanent (active) holds with their holder's Telegram ID.
+
+    Returns plain (id, user_id, phone_number_str, range_id, telegram_id) rows,
+    which stay usable after later commits expire the session's objects.
+    """
+    return db_session.execute(
+        select(
+            NumberHold.id, NumberHold.user_id, NumberHold.phone_number_str,
+            NumberHold.range_id, User.telegram_id
+        )
+        .join(User, User.id == NumberHold.user_id)
+        .where(NumberHold.is_permanent.is_(False))
     ).all()
 
 
-def update_first_retry_time(db_session, user, phone_number_str):
-    """Update first retry time for a number hold."""
-    hold = db_session.query(NumberHold).filter_by(
-        user_id=user.id,
-        phone_number_str=str(phone_number_str)
-    ).first()
-    
-    if hold and not hold.first_retry_time:
-        hold.first_retry_time = datetime.utcnow()
-        db_session.commit()
-        return True
-    return False
+def get_hold_summary(db_session, now=None, retry_window_minutes=5):
+    """
+    Count holds by state in a single aggregate query.
+    A temporary hold is expired once retry_window_minutes have passed since
+    its first retry.
+    Returns: (total, permanent, active_temporary, expired)
+    """
+    if now is None:
+        now = datetime.utcnow()
+    cutoff = now - timedelta(minutes=retry_window_minutes)
+
+    retried_temporary = and_(
+        NumberHold.is_permanent.is_(False),
+        NumberHold.first_retry_time.isnot(None)
+    )
+
+    total, permanent, active, expired = db_session.query(
+        func.count(NumberHold.id),
+        func.coalesce(func.sum(case((NumberHold.is_permanent.is_(True), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((and_(retried_temporary, NumberHold.first_retry_time >= cutoff), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((and_(retried_temporary, NumberHold.first_retry_time < cutoff), 1), else_=0)), 0)
+    ).one()
+
+    return total, permanent, active, expired
+
+
+def get_bot_stats(db_session):
+    """
+    Collect the admin statistics figures.
+    Returns: dict with user, balance, hold and today's activity totals
+    """
+    # User aggregates in a single round-trip
+    (
+        total_users,
+        admin_users,
+        banned_users,
+        total_balance,
+        total_spent,
+        total_sms,
+    ) = db_session.query(
+        func.count(User.id),
+        func.coalesce(func.sum(case((User.is_admin.is_(True), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((User.is_banned.is_(True), 1), else_=0)), 0),
+        func.coalesce(func.sum(User.balance), 0.0),
+        func.coalesce(func.sum(User.total_spent), 0.0),
+        func.coalesce(func.sum(User.total_sms_received), 0),
+    ).one()
+
+    # Number holds stats in a single round-trip
+    total_holds, permanent_holds = db_session.query(
+        func.count(NumberHold.id),
+        func.coalesce(func.sum(case((NumberHold.is_permanent.is_(True), 1), else_=0)), 0),
+    ).one()
+
+    # Half-open range on the raw column so the timestamp index can be used
+    start_of_day = datetime.combine(datetime.utcnow().date(), time.min)
+    today_logs = db_session.query(AccessLog).filter(
+        AccessLog.timestamp >= start_of_day,
+        AccessLog.timestamp < start_of_day + timedelta(days=1)
+    ).count()
+
+    return {
+        'total_users': total_users,
+        'admin_users': admin_users,
+        'banned_users': banned_users,
+        'total_balance': total_balance,
+        'total_spent': total_spent,
+        'total_sms': total_sms,
+        'total_holds': total_holds,
+        'permanent_holds': permanent_holds,
+        'today_logs': today_logs,
+    }
+
+
+def get_hold_breakdown(db_session, limit=10):
+    """
+    Get the users and ranges with the most holds.
+    Returns: (holds_by_user, holds_by_range)
+    """
+    holds_by_user = db_session.query(
+        User.telegram_id,
+        User.username,
+        func.count(NumberHold.id).label('hold_count'),
+        func.sum(func.cast(NumberHold.is_permanent, Integer)).label('permanent_count')
+    ).join(NumberHold).group_by(User.id).order_by(func.count(NumberHold.id).desc()).limit(limit).all()
+
+    holds_by_range = db_session.query(
+        NumberHold.range_id,
+        func.count(NumberHold.id).label('hold_count')
+    ).group_by(NumberHold.range_id).order_by(func.count(NumberHold.id).desc()).limit(limit).all()
+
+    return holds_by_user, holds_by_range
+
+
+def update_first_retry_time(db_session, user, phone_number_str, now=None):
+    """Set the first retry time for a number hold, unless it is already set."""
+    # The "not set yet" check is part of the UPDATE, so the hold isn't loaded first
+    result = db_session.execute(
+        update(NumberHold)
+        .where(
+            NumberHold.user_id == user.id,
+            NumberHold.phone_number_str == str(phone_number_str),
+            NumberHold.first_retry_time.is_(None)
+        )
+        .values(first_retry_time=now or datetime.utcnow())
+    )
+    db_session.commit()
+    return result.rowcount > 0
 
 
 # CSV Upload and Range Management Functions
@@ -475,9 +916,21 @@ def generate_range_unique_id(range_name):
     return hashlib.sha256(range_name.encode()).hexdigest()[:16]
 
 
-def import_csv_data(db_session, csv_file_path):
+def _get_range_ids(db_session, unique_ids):
+    """Map range unique IDs to row IDs, querying in chunks. Unknown IDs are left out."""
+    unique_ids = list(unique_ids)
+    range_ids = {}
+    for start in range(0, len(unique_ids), CSV_LOOKUP_CHUNK_SIZE):
+        chunk = unique_ids[start:start + CSV_LOOKUP_CHUNK_SIZE]
+        range_ids.update(db_session.execute(
+            select(Range.unique_id, Range.id).where(Range.unique_id.in_(chunk))
+        ).all())
+    return range_ids
+
+
+def import_csv_data(db_session, csvfile):
     """
-    Import ranges and phone numbers from CSV file.
+    Import ranges and phone numbers from an open text-mode CSV file object.
     Expected CSV columns: Range, Number (other columns ignored)
     Returns: (success_count, error_count, errors_list)
     """
@@ -486,74 +939,124 @@ def import_csv_data(db_session, csv_file_path):
     success_count = 0
     error_count = 0
     errors = []
-    range_cache = {}  # Cache to avoid repeated DB queries
+    parsed = []  # (number, range_name) in file order
+    inserted = 0  # New numbers already committed
     
     try:
-        with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
-            # Try to detect the delimiter
-            sample = csvfile.read(1024)
-            csvfile.seek(0)
-            sniffer = csv.Sniffer()
+        # Try to detect the delimiter
+        sample = csvfile.read(1024)
+        csvfile.seek(0)
+        sniffer = csv.Sniffer()
+        try:
+            dialect = sniffer.sniff(sample)
+            reader = csv.reader(csvfile, dialect=dialect)
+        except:
+            reader = csv.reader(csvfile)
+        
+        # Find the Range and Number columns once (case-insensitive) and read
+        # rows as plain lists instead of building a dict per row
+        range_col = number_col = None
+        for col, key in enumerate(next(reader, None) or []):
+            key = key.strip().lower()
+            if key == 'range':
+                range_col = col
+            elif key == 'number':
+                number_col = col
+        
+        rows_with_data = (row for row in reader if row)  # Skip blank lines
+        for row_num, row in enumerate(rows_with_data, start=2):  # Start at 2 (1 is header)
             try:
-                dialect = sniffer.sniff(sample)
-                reader = csv.DictReader(csvfile, dialect=dialect)
-            except:
-                reader = csv.DictReader(csvfile)
-            
-            for row_num, row in enumerate(reader, start=2):  # Start at 2 (1 is header)
-                try:
-                    # Get range and number (case-insensitive)
-                    range_name = None
-                    number = None
-                    
-                    for key in row.keys():
-                        if key and key.strip().lower() == 'range':
-                            range_name = row[key].strip()
-                        elif key and key.strip().lower() == 'number':
-                            number = row[key].strip()
-                    
-                    if not range_name or not number:
-                        errors.append(f"Row {row_num}: Missing Range or Number")
-                        error_count += 1
-                        continue
-                    
-                    # Get or create range
-                    if range_name not in range_cache:
-                        unique_id = generate_range_unique_id(range_name)
-                        range_obj = db_session.query(Range).filter_by(unique_id=unique_id).first()
-                        if not range_obj:
-                            range_obj = Range(unique_id=unique_id, name=range_name)
-                            db_session.add(range_obj)
-                            db_session.flush()  # Get the ID
-                        range_cache[range_name] = range_obj
-                    else:
-                        range_obj = range_cache[range_name]
-                    
-                    # Check if number already exists
-                    existing = db_session.query(PhoneNumber).filter_by(number=number).first()
-                    if existing:
-                        # Update range if different
-                        if existing.range_id != range_obj.id:
-                            existing.range_id = range_obj.id
-                            success_count += 1
-                    else:
-                        # Create new phone number
-                        phone_number = PhoneNumber(
-                            range_id=range_obj.id,
-                            number=number
-                        )
-                        db_session.add(phone_number)
-                        success_count += 1
+                range_name = row[range_col].strip() if range_col is not None and range_col < len(row) else None
+                number = row[number_col].strip() if number_col is not None and number_col < len(row) else None
                 
-                except Exception as e:
-                    errors.append(f"Row {row_num}: Database error - {str(e)}")
+                if not range_name or not number:
+                    errors.append(f"Row {row_num}: Missing Range or Number")
                     error_count += 1
+                    continue
+                
+                parsed.append((number, range_name))
             
+            except Exception as e:
+                errors.append(f"Row {row_num}: Parse error - {str(e)}")
+                error_count += 1
+        
+        # Resolve the ranges named in the file with a few IN queries, and
+        # create the missing ones in a single executemany
+        # Hash each distinct name once, not once per row
+        unique_ids = {name: generate_range_unique_id(name) for name in {name for _, name in parsed}}
+        range_ids = _get_range_ids(db_session, set(unique_ids.values()))
+        new_ranges = {}  # unique_id -> name
+        for name, unique_id in unique_ids.items():
+            if unique_id not in range_ids:
+                new_ranges.setdefault(unique_id, name)
+        if new_ranges:
+            now = datetime.utcnow()
+            db_session.execute(insert(Range), [
+                {'unique_id': unique_id, 'name': name, 'created_at': now, 'updated_at': now}
+                for unique_id, name in new_ranges.items()
+            ])
+            range_ids.update(_get_range_ids(db_session, new_ranges))
+        rows = [(number, range_ids[unique_ids[name]]) for number, name in parsed]
+        
+        # Look up numbers that already exist with a few IN queries
+        all_numbers = list({number for number, _ in rows})
+        existing = {}  # number -> (phone_number_id, range_id)
+        for start in range(0, len(all_numbers), CSV_LOOKUP_CHUNK_SIZE):
+            chunk = all_numbers[start:start + CSV_LOOKUP_CHUNK_SIZE]
+            existing.update(
+                (number, (phone_id, range_id))
+                for phone_id, number, range_id in db_session.query(
+                    PhoneNumber.id, PhoneNumber.number, PhoneNumber.range_id
+                ).filter(PhoneNumber.number.in_(chunk))
+            )
+        
+        new_numbers = {}  # number -> range_id
+        moved_numbers = {}  # phone_number_id -> range_id
+        for number, range_id in rows:
+            if number in new_numbers:
+                # Repeated in this file, the last range wins
+                if new_numbers[number] != range_id:
+                    new_numbers[number] = range_id
+                    success_count += 1
+            elif number in existing:
+                # Update range if different
+                phone_id, current_range_id = existing[number]
+                if current_range_id != range_id:
+                    existing[number] = (phone_id, range_id)
+                    moved_numbers[phone_id] = range_id
+                    success_count += 1
+            else:
+                new_numbers[number] = range_id
+                success_count += 1
+        
+        if moved_numbers:
+            db_session.bulk_update_mappings(
+                PhoneNumber,
+                [{'id': phone_id, 'range_id': range_id} for phone_id, range_id in moved_numbers.items()]
+            )
+        
+        db_session.commit()
+        
+        # Insert new numbers in batches, committing each so a large upload
+        # doesn't hold the write lock against the rest of the bot. Rows are
+        # built per batch and share one timestamp rather than calling the
+        # column default per row
+        now = datetime.utcnow()
+        new_items = list(new_numbers.items())
+        for start in range(0, len(new_items), CSV_INSERT_BATCH_SIZE):
+            db_session.bulk_insert_mappings(PhoneNumber, [
+                {'range_id': range_id, 'number': number, 'created_at': now}
+                for number, range_id in new_items[start:start + CSV_INSERT_BATCH_SIZE]
+            ])
             db_session.commit()
-            
+            inserted += min(CSV_INSERT_BATCH_SIZE, len(new_items) - start)
+        
     except Exception as e:
         db_session.rollback()
-        errors.append(f"File error: {str(e)}")
+        if inserted:
+            errors.append(f"File error after {inserted} new numbers were saved: {str(e)}")
+        else:
+            errors.append(f"File error: {str(e)}")
         error_count += 1
     
     return success_count, error_count, errors
@@ -561,8 +1064,6 @@ def import_csv_data(db_session, csv_file_path):
 
 def get_all_ranges(db_session):
     """Get all ranges with count of phone numbers."""
-    from sqlalchemy import func
-    
     ranges = db_session.query(
         Range,
         func.count(PhoneNumber.id).label('number_count')
@@ -571,6 +1072,22 @@ def get_all_ranges(db_session):
     return [(r, count) for r, count in ranges]
 
 
+def get_all_ranges_with_prices(db_session):
+    """Get all ranges with count of phone numbers and price, in one query."""
+    ranges = db_session.query(
+        Range,
+        func.count(PhoneNumber.id).label('number_count'),
+        PriceRange.price
+    ).outerjoin(PhoneNumber).outerjoin(
+        PriceRange, PriceRange.range_unique_id == Range.unique_id
+    ).group_by(Range.id).order_by(Range.name).all()
+    
+    return [
+        (r, count, price if price is not None else DEFAULT_RANGE_PRICE)
+        for r, count, price in ranges
+    ]
+
+
 def get_range_by_unique_id(db_session, unique_id):
     """Get a range by its unique ID."""
     return db_session.query(Range).filter_by(unique_id=unique_id).first()
@@ -585,14 +1102,13 @@ def get_available_numbers_for_range(db_session, range_unique_id, limit=100):
     if not range_obj:
         return []
     
-    # Get phone numbers that are not currently held (temporary or permanent)
-    held_number_ids = db_session.query(NumberHold.phone_number_id).filter(
-        NumberHold.phone_number_id.isnot(None)
-    ).distinct().subquery()
-    
+    # Get phone numbers that are not currently held (temporary or permanent).
+    # NOT EXISTS probes the phone_number_id index per candidate instead of
+    # materializing every held id first
+    is_held = exists().where(NumberHold.phone_number_id == PhoneNumber.id)
     available_numbers = db_session.query(PhoneNumber).filter(
         PhoneNumber.range_id == range_obj.id,
-        ~PhoneNumber.id.in_(held_number_ids)
+        ~is_held
     ).limit(limit).all()
     
     return available_numbers
@@ -625,4 +1141,5 @@ def set_range_price(db_session, range_unique_id, range_name, price, admin_user):
         db_session.add(price_range)
     
     db_session.commit()
+    invalidate_price_cache()
     return price_range
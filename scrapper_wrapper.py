@@ -2,6 +2,7 @@
 
 import os
 import logging
+import threading
 import requests
 from scrapper import login, get_sms_ranges, get_sms_numbers, get_sms_messages, load_cookies, save_cookies, are_cookies_valid
 from dotenv import load_dotenv
@@ -31,12 +32,22 @@ class ScrapperSession:
         })
         self._authenticated = False
         self.base_url = None
+        # Requests may run in worker threads; only one of them should log in
+        self._auth_lock = threading.Lock()
         
     def ensure_authenticated(self):
         """Ensure the session is authenticated."""
         if self._authenticated:
             return True
-            
+        
+        with self._auth_lock:
+            # Another thread may have logged in while we waited
+            if self._authenticated:
+                return True
+            return self._authenticate()
+    
+    def _authenticate(self):
+        """Authenticate using saved cookies or a fresh login."""
         # Try to load saved cookies
         cookies_loaded = load_cookies(self.session)
         
@@ -45,8 +56,8 @@ class ScrapperSession:
             try:
                 test_response = self.session.get(API_URL, timeout=10)
                 if test_response.status_code == 200 and "login" not in test_response.url.lower():
-                    self._authenticated = True
                     self._extract_base_url()
+                    self._authenticated = True
                     logger.info("Authentication successful (using saved cookies)")
                     return True
             except requests.Timeout:
@@ -59,8 +70,8 @@ class ScrapperSession:
             logger.info("Attempting to authenticate with credentials...")
             login_response = login(self.session, API_URL, LOGIN_USERNAME, PASSWORD)
             save_cookies(self.session)
-            self._authenticated = True
             self._extract_base_url()
+            self._authenticated = True
             logger.info("Authentication successful (new login)")
             return True
         except requests.Timeout as e:
@@ -144,13 +155,17 @@ class ScrapperSession:
         return self.get_sms_messages("", date_from=date_from, date_to=date_to, start=start, length=length)
 
 
-# Global scrapper session instance
+# Global scrapper session instance, shared so its connection pool and
+# login cookies are reused across requests
 _scrapper_session = None
+_scrapper_session_lock = threading.Lock()
 
 
 def get_scrapper_session():
     """Get or create the global scrapper session."""
     global _scrapper_session
     if _scrapper_session is None:
-        _scrapper_session = ScrapperSession()
+        with _scrapper_session_lock:
+            if _scrapper_session is None:
+                _scrapper_session = ScrapperSession()
     return _scrapper_session